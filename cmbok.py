@@ -1,4 +1,5 @@
 import logging
+import multiprocessing
 import sys
 import time
 import traceback
@@ -13,7 +14,12 @@ from qfluentwidgets import FluentIcon as FIF, SplashScreen, InfoBarIcon, InfoBar
 from qfluentwidgets import NavigationItemPosition, FluentWindow, SubtitleLabel, setFont, NavigationAvatarWidget, \
     MessageBox, FluentTranslator, toggleTheme
 
+from common.calibre_util import calibre_pool
+from common.comic_packager import post_process_stage
 from common.config import cfg, LOG_PATH
+from common.download_loop import download_loop
+from common.download_scheduler import download_scheduler
+from common.progress_writer import progress_writer
 from common.sqlite_util import SQLiteDatabase
 from common.util import check_url, clean_file
 from common.view_util import info_bar_tip
@@ -205,6 +211,8 @@ class Window(FluentWindow):
         logging.info("应用程序启动")
 
     def closeEvent(self, event):
+        # 写入还在队列中的下载进度
+        progress_writer.flush()
         with SQLiteDatabase() as db:
             historys = db.query_data('cmbok_download_history', {'status': 1})
             if len(historys) > 0:
@@ -225,6 +233,8 @@ class Window(FluentWindow):
 
 
 if __name__ == '__main__':
+    # 打包后后期处理子进程需要
+    multiprocessing.freeze_support()
     QApplication.setHighDpiScaleFactorRoundingPolicy(
         Qt.HighDpiScaleFactorRoundingPolicy.PassThrough)
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
@@ -246,4 +256,11 @@ if __name__ == '__main__':
 
     w = Window()
     w.show()
+    # 继续上次退出时还在等待的下载任务
+    download_scheduler.resume_waiting()
     app.exec()
+    # 取消还在运行的下载并关闭连接池
+    download_loop.stop()
+    # 关闭后期处理进程池和calibre转换线程，避免退出时残留子进程
+    post_process_stage.shutdown()
+    calibre_pool.shutdown()
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# 同时运行的calibre进程数量
+CALIBRE_WORKER_NUM = 2
+# 单个转换任务超时时间（秒）
+CALIBRE_TIMEOUT = 600
+
+
+# 是否是可执行的ebook-convert，不限制文件名，便于使用其他安装位置或替身程序
+def is_calibre_executable(calibre_path):
+    return bool(calibre_path) and os.path.isfile(calibre_path) and os.access(calibre_path, os.X_OK)
+
+
+# 以较低优先级运行ebook-convert，超时后结束进程，成功返回True
+def convert_ebook(calibre_path, output_device, title, input_file, output_file, timeout=CALIBRE_TIMEOUT):
+    if not os.path.isfile(input_file):
+        logging.info(f"文件 {input_file} 不存在！")
+        return False
+    args = [calibre_path, input_file, output_file, '--output-profile', output_device, '--title', title]
+    try:
+        if os.name == 'nt':
+            process = subprocess.Popen(args, creationflags=subprocess.BELOW_NORMAL_PRIORITY_CLASS)
+        else:
+            process = subprocess.Popen(args)
+    except OSError:
+        logging.info(traceback.format_exc())
+        logging.info(f"启动 {calibre_path} 失败")
+        return False
+    if os.name != 'nt':
+        try:
+            os.setpriority(os.PRIO_PROCESS, process.pid, 10)
+        except OSError:
+            pass
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        logging.info(f"转换超时（{timeout}秒）：{input_file}")
+        return False
+    if process.returncode != 0:
+        logging.info(f"转换过程中发生错误，返回码: {process.returncode}")
+        return False
+    logging.info(f"转换成功！文件已保存为 {output_file}")
+    return True
+
+
+class CalibreWorkerPool:
+    """ calibre转换队列，限制同时运行的ebook-convert进程数量 """
+
+    def __init__(self, max_workers=CALIBRE_WORKER_NUM):
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='Calibre')
+            return self.executor
+
+    # 提交转换任务并等待完成
+    async def convert(self, calibre_path, output_device, title, input_file, output_file):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.get_executor(), convert_ebook, calibre_path, output_device, title, input_file, output_file)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+calibre_pool = CalibreWorkerPool()
@@ -0,0 +1,61 @@
+import logging
+import os
+import zipfile
+from html import escape
+
+
+# 生成ComicInfo.xml内容
+def comic_info_xml(series, title, writer, page_count):
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<ComicInfo xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <Title>{escape(title)}</Title>
+  <Series>{escape(series)}</Series>
+  <Writer>{escape(writer or '')}</Writer>
+  <PageCount>{page_count}</PageCount>
+</ComicInfo>
+'''
+
+
+class CbzWriter:
+    """ 写入cbz，图片不压缩直接存储，文件名按页码补零，阅读器按文件名排序即为页面顺序 """
+
+    def __init__(self, output_path, series, title, writer, page_count):
+        self.output_path = output_path
+        self.series = series
+        self.title = title
+        self.writer = writer
+        # 页码补零的位数
+        self.width = max(3, len(str(page_count)))
+        self.count = 0
+        # 先写入临时文件，完成后再重命名
+        self.temp_path = f'{output_path}.part'
+        self.zip = zipfile.ZipFile(self.temp_path, 'w', zipfile.ZIP_STORED)
+
+    # part为跨页拆分后的序号，0表示没有拆分
+    def page_name(self, index, ext, part=0):
+        suffix = f'_{part}' if part else ''
+        return f'{index + 1:0{self.width}d}{suffix}{ext.lower()}'
+
+    # 写入一页图片内容，index为页面顺序
+    def add_image(self, index, data, ext, part=0):
+        self.zip.writestr(self.page_name(index, ext, part), data)
+        self.count += 1
+
+    # 写入一页图片文件
+    def add_file(self, index, file_path):
+        self.zip.write(file_path, self.page_name(index, os.path.splitext(file_path)[1]))
+        self.count += 1
+
+    def close(self):
+        self.zip.writestr('ComicInfo.xml', comic_info_xml(self.series, self.title, self.writer, self.count),
+                          compress_type=zipfile.ZIP_DEFLATED)
+        self.zip.close()
+        os.replace(self.temp_path, self.output_path)
+
+    # 出错时删除未完成的文件
+    def abort(self):
+        self.zip.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            logging.info(f'删除未完成的cbz失败: {self.temp_path}')
@@ -0,0 +1,85 @@
+import time
+
+KB = 1024
+MB = 1024 * 1024
+
+
+class ChunkController:
+    """ 根据测得的延迟和吞吐量自适应调整分块大小和并发数 """
+
+    def __init__(self, file_size, min_chunk_size=256 * KB, max_chunk_size=16 * MB, min_concurrency=1,
+                 max_concurrency=16, target_latency=2.0):
+        self.file_size = file_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        # 单个分块的目标耗时（秒）
+        self.target_latency = target_latency
+        # 从小的分块和并发开始
+        self.chunk_size = min_chunk_size
+        self.concurrency = min(2, max_concurrency)
+        # 单连接速度（字节/秒），指数加权平均
+        self.stream_speed = None
+        # 当前评估窗口
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_count = 0
+        self.best_throughput = None
+        # 统计信息
+        self.start_time = time.monotonic()
+        self.total_bytes = 0
+        self.chunks = 0
+        self.errors = 0
+        self.peak_concurrency = self.concurrency
+
+    # 下一个分块的大小，不超过文件按并发数均分后的大小
+    def next_chunk_size(self):
+        share = -(-self.file_size // max(self.concurrency, 1))
+        return max(self.min_chunk_size, min(self.chunk_size, share))
+
+    # 分块下载成功，size为字节数，elapsed为耗时（秒）
+    def on_success(self, size, elapsed):
+        self.chunks += 1
+        self.total_bytes += size
+        speed = size / max(elapsed, 0.001)
+        self.stream_speed = speed if self.stream_speed is None else self.stream_speed * 0.7 + speed * 0.3
+
+        # 分块大小：让单块耗时接近目标时长，每次最多翻倍，按64KB对齐
+        target = int(self.stream_speed * self.target_latency) // (64 * KB) * (64 * KB)
+        self.chunk_size = max(self.min_chunk_size, min(target, self.chunk_size * 2, self.max_chunk_size))
+
+        # 并发数：每完成一轮评估一次总吞吐，有提升则加性增加
+        self.window_bytes += size
+        self.window_count += 1
+        if self.window_count >= self.concurrency:
+            now = time.monotonic()
+            throughput = self.window_bytes / max(now - self.window_start, 0.001)
+            if self.best_throughput is None or throughput > self.best_throughput * 1.05:
+                self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+                self.peak_concurrency = max(self.peak_concurrency, self.concurrency)
+            self.best_throughput = max(self.best_throughput or 0, throughput)
+            self.reset_window()
+
+    # 分块出错或超时，分块大小和并发数乘性减少
+    def on_error(self):
+        self.errors += 1
+        self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+        self.best_throughput = None
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_count = 0
+
+    # 本次下载选择的参数，保存到下载记录用于调整默认值
+    def report(self):
+        elapsed = max(time.monotonic() - self.start_time, 0.001)
+        return {'chunk_size': self.chunk_size,
+                'concurrency': self.concurrency,
+                'peak_concurrency': self.peak_concurrency,
+                'chunks': self.chunks,
+                'errors': self.errors,
+                'avg_speed': int(self.total_bytes / elapsed)}
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ebooklib import epub
+from natsort import natsorted
+
+from common.cbz_util import CbzWriter
+from common.util import img_to_pdf, del_folder, del_folder_images
+
+# 章节目录中的图片格式，打包时忽略目录中的epub、cbz等其他文件
+PAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+# 章节生成文件的保存目录，epub_save_folder为是否保存到漫画根目录
+def chapter_save_path(download_folder, comic_name, chapter_name, epub_save_folder):
+    if epub_save_folder:
+        return f"{download_folder}/{comic_name}"
+    return f"{download_folder}/{comic_name}/{chapter_name}"
+
+
+# 合并章节图片为epub
+def images_to_epub(sorted_files, path, output_path, options):
+    book = epub.EpubBook()
+    book.set_identifier(str(options['comic_id']))
+    book.set_title(options['chapter_name'])
+    book.set_language('en')
+    book.add_author(options['comic_author'])
+    # 漫画图片目录
+    for index, file_name in enumerate(sorted_files):
+        img_item = epub.EpubItem(uid=file_name, file_name=file_name,
+                                 media_type='image/jpeg')
+        with open(f'{path}/{file_name}', 'rb') as f:
+            img_item.set_content(f.read())
+            if index == 0:
+                book.add_item(epub.EpubItem(uid="cover", file_name=file_name,
+                                            media_type='image/jpeg',
+                                            content=img_item.get_content()))
+        book.add_item(img_item)
+
+        chapter = epub.EpubHtml(title=f'Image {index}', file_name=f'chap_{index}.xhtml', lang='en')
+        chapter.set_content(f'<html><body><img src="{img_item.file_name}" /></body></html>')
+        book.add_item(chapter)
+        book.spine.append(chapter)
+    nav = epub.EpubNav()
+    book.add_item(nav)
+    epub.write_epub(output_path, book)
+
+
+# 章节后期处理：生成epub、cbz、pdf，删除章节图片，在子进程中执行
+# options为章节信息和配置，返回各阶段耗时
+def package_chapter(options):
+    started = time.time()
+    timings = {}
+    comic_name = options['comic_name']
+    chapter_name = options['chapter_name']
+    download_folder = options['download_folder']
+    path = f"{download_folder}/{comic_name}/{chapter_name}"
+
+    # 获取目录下的所有图片
+    files = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))
+             and os.path.splitext(f)[1].lower() in PAGE_EXTENSIONS]
+    # 进行自然排序
+    sorted_files = natsorted(files)
+
+    save_path = chapter_save_path(download_folder, comic_name, chapter_name, options['epub_save_folder'])
+
+    # 是否生成epub
+    if options['is_save_epub']:
+        stage_start = time.monotonic()
+        images_to_epub(sorted_files, path, f'{save_path}/{comic_name}_{chapter_name}.epub', options)
+        timings['epub'] = round(time.monotonic() - stage_start, 2)
+
+    # 是否生成cbz
+    if options['is_save_cbz']:
+        stage_start = time.monotonic()
+        cbz = CbzWriter(f'{save_path}/{comic_name}_{chapter_name}.cbz', comic_name, chapter_name,
+                        options['comic_author'], len(sorted_files))
+        try:
+            for index, file_name in enumerate(sorted_files):
+                cbz.add_file(index, os.path.join(path, file_name))
+            cbz.close()
+        except Exception:
+            cbz.abort()
+            raise
+        timings['cbz'] = round(time.monotonic() - stage_start, 2)
+
+    # 是否生成pdf
+    if options['is_save_pdf']:
+        stage_start = time.monotonic()
+        img_to_pdf(sorted_files, path, f'{save_path}/{comic_name}_{chapter_name}.pdf')
+        timings['pdf'] = round(time.monotonic() - stage_start, 2)
+
+    # 合并epub之后，根据配置是否删除章节图片
+    if options['is_del_chapter_images']:
+        if options['epub_save_folder']:
+            del_folder(path)
+        else:
+            del_folder_images(path)
+
+    timings['started'] = started
+    return timings
+
+
+# 后期处理子进程的日志写入主进程的日志文件，打包后子进程不会执行主界面的日志配置
+def init_worker_logging(log_file):
+    if log_file:
+        logging.basicConfig(filename=log_file, level=logging.INFO,
+                            format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class PostProcessStage:
+    """ 后期处理进程池，下载协程提交任务后继续下载，由CPU核心完成打包 """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or max(1, min(os.cpu_count() or 1, 4))
+        self.executor = None
+        self.lock = threading.Lock()
+        # 已提交还未完成的任务数量
+        self.depth = 0
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                log_file = next((handler.baseFilename for handler in logging.getLogger().handlers
+                                 if isinstance(handler, logging.FileHandler)), None)
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker_logging,
+                                                    initargs=(log_file,))
+            return self.executor
+
+    # 提交任务并等待结果，返回(结果, 提交时的队列深度, 排队耗时)
+    async def run(self, func, options):
+        with self.lock:
+            self.depth += 1
+            queue_depth = self.depth
+        submitted = time.time()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.get_executor(), func, options)
+            wait = round(max(result.pop('started', submitted) - submitted, 0), 2)
+            return result, queue_depth, wait
+        finally:
+            with self.lock:
+                self.depth -= 1
+
+    # 提交单个处理函数并等待结果，用于按页转码等小任务
+    async def call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.get_executor(), func, *args)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                logging.info('关闭后期处理进程池')
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+post_process_stage = PostProcessStage()
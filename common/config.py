@@ -34,6 +34,14 @@ class Config(QConfig):
     # 下载最大线程
     downloadThreadNum = RangeConfigItem("Thread", "DownloadThreadNum", 2, RangeValidator(1, 5))
 
+    # 图书下载限速（KB/s），0表示不限速
+    bookSpeedLimit = OptionsConfigItem("Thread", "BookSpeedLimit", 0, OptionsValidator(
+        [0, 256, 512, 1024, 2048, 5120, 10240, 20480]))
+
+    # 漫画下载限速（KB/s），0表示不限速
+    comicSpeedLimit = OptionsConfigItem("Thread", "ComicSpeedLimit", 0, OptionsValidator(
+        [0, 256, 512, 1024, 2048, 5120, 10240, 20480]))
+
     # 下载目录
     downloadFolder = ConfigItem(
         "Folders", "DownloadFolder", "app/download", FolderValidator())
@@ -44,6 +52,15 @@ class Config(QConfig):
     # 是否删除章节图片
     isDelChapterImages = ConfigItem("Chapter", "IsDelChapterImages", True, BoolValidator())
 
+    # 是否生成epub
+    isSaveEpub = ConfigItem("Comic", "IsSaveEpub", True, BoolValidator())
+
+    # 是否生成cbz
+    isSaveCbz = ConfigItem("Comic", "IsSaveCbz", False, BoolValidator())
+
+    # 边下载边写入epub/cbz，不保存章节图片
+    isStreamEpub = ConfigItem("Comic", "IsStreamEpub", False, BoolValidator())
+
     # 是否合并保存PDF
     isSavePdf = ConfigItem("Comic", "IsSavePdf", False, BoolValidator())
 
@@ -62,6 +79,29 @@ class Config(QConfig):
          'sony', 'sony300', 'sony900', 'sony-landscape', 'sonyt3', 'tablet', 'generic_eink_large', 'generic_eink',
          'generic_eink_hd']))
 
+    # 转换格式
+    calibreOutputFormat = OptionsConfigItem("Comic", "CalibreOutputFormat", 'mobi',
+                                            OptionsValidator(['mobi', 'azw3']))
+
+    # 图片缓存容量（MB），0表示不缓存
+    imageCacheSize = OptionsConfigItem("Comic", "ImageCacheSize", 1024, OptionsValidator(
+        [0, 512, 1024, 2048, 5120, 10240]))
+
+    # 是否自动裁剪页面白边
+    isCropMargins = ConfigItem("Comic", "IsCropMargins", False, BoolValidator())
+
+    # 是否拆分横向跨页
+    isSplitSpreads = ConfigItem("Comic", "IsSplitSpreads", False, BoolValidator())
+
+    # 拆分跨页时右半页在前（从右往左阅读）
+    splitRightFirst = ConfigItem("Comic", "SplitRightFirst", True, BoolValidator())
+
+    # 是否按转换设备转码图片（缩放、灰度、重新压缩）
+    isTranscodeImages = ConfigItem("Comic", "IsTranscodeImages", False, BoolValidator())
+
+    # 转码图片质量
+    transcodeQuality = RangeConfigItem("Comic", "TranscodeQuality", 80, RangeValidator(30, 95))
+
     # main window
     dpiScale = OptionsConfigItem(
         "MainWindow", "DpiScale", "Auto", OptionsValidator([1, 1.25, 1.5, 1.75, 2, "Auto"]), restart=True)
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import threading
+import traceback
+
+from common.http_client import close_session
+
+
+class DownloadLoop:
+    """ 所有下载共享的后台事件循环线程：界面线程通过submit提交下载协程，
+    连接池、限速和调度在同一个事件循环中共享，不再为每个下载任务创建线程和事件循环 """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+
+    # 首次提交时启动事件循环线程
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.run, name='DownloadLoop', daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    # 从任意线程提交协程，返回concurrent.futures.Future
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    # 退出时取消还在运行的下载并关闭连接池
+    def stop(self, timeout=5):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout)
+            except Exception:
+                logging.info(traceback.format_exc())
+                logging.info('关闭下载事件循环超时')
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
+
+    async def shutdown(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await close_session()
+
+
+download_loop = DownloadLoop()
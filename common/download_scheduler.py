@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+
+from common.config import cfg
+from common.sqlite_util import SQLiteDatabase
+
+# 下载记录状态
+STATUS_WAITING = 2
+STATUS_PAUSED = 4
+STATUS_CANCELLED = -5
+
+
+class DownloadStopped(Exception):
+    """ 下载任务被暂停或取消 """
+
+
+class DownloadScheduler:
+    """ 漫画章节和图书共享的下载调度：按优先级和加入顺序分配全局并发名额（downloadThreadNum），
+    支持暂停、继续、取消和调整优先级，任务状态保存在下载记录表中，线程安全，
+    名额变化时只唤醒被分配名额或被停止的等待任务 """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 等待中的任务 下载记录id -> (优先级, 加入顺序)
+        self.waiting = {}
+        # 正在等待名额的任务 下载记录id -> (事件循环, 事件)
+        self.waiters = {}
+        # 下载中的任务
+        self.running = set()
+        # 下载中被暂停或取消的任务 下载记录id -> 状态，下载协程检查后停止
+        self.stopped = {}
+        # 停止后需要重新开始的任务
+        self.relaunch = set()
+        self.sequence = itertools.count()
+        # launcher(下载记录) 为下载记录创建下载任务，可能在下载线程中调用
+        self.launcher = None
+        # cleaner(下载记录) 删除取消的任务的临时文件和断点续传记录
+        self.cleaner = None
+
+    def set_launcher(self, launcher):
+        self.launcher = launcher
+
+    def set_cleaner(self, cleaner):
+        self.cleaner = cleaner
+
+    # 加入等待队列，任务已在队列或下载中时返回False
+    def enqueue(self, history_id, priority=0):
+        with self.lock:
+            if history_id in self.waiting or history_id in self.running:
+                return False
+            self.waiting[history_id] = (priority or 0, next(self.sequence))
+            return True
+
+    # 从等待队列移除，不再下载
+    def discard(self, history_id):
+        with self.lock:
+            self.waiting.pop(history_id, None)
+
+    # 等待轮到该任务且有空闲名额，任务在等待时被暂停或取消返回False
+    async def acquire(self, history_id):
+        event = asyncio.Event()
+        with self.lock:
+            if history_id not in self.waiting:
+                return False
+            self.waiters[history_id] = (asyncio.get_running_loop(), event)
+        try:
+            self.dispatch()
+            await event.wait()
+        finally:
+            with self.lock:
+                self.waiters.pop(history_id, None)
+        return history_id in self.running
+
+    # 按优先级从高到低、相同时先加入的先下载，把空闲名额分配给正在等待的任务，并唤醒已被停止的等待任务
+    def dispatch(self):
+        with self.lock:
+            ready = [history_id for history_id in self.waiters if history_id in self.waiting]
+            free = cfg.get(cfg.downloadThreadNum) - len(self.running)
+            wake = []
+            if free > 0 and ready:
+                for history_id in heapq.nsmallest(free, ready, key=lambda key: (-self.waiting[key][0],
+                                                                                self.waiting[key][1])):
+                    del self.waiting[history_id]
+                    self.running.add(history_id)
+                    wake.append(self.waiters[history_id])
+            wake.extend(waiter for history_id, waiter in self.waiters.items()
+                        if history_id not in self.waiting and history_id not in self.running)
+        for loop, event in wake:
+            loop.call_soon_threadsafe(event.set)
+
+    # 任务结束，释放名额
+    def release(self, history_id):
+        with self.lock:
+            self.running.discard(history_id)
+            self.stopped.pop(history_id, None)
+            relaunch = history_id in self.relaunch
+            self.relaunch.discard(history_id)
+        self.dispatch()
+        if relaunch:
+            self.launch(history_id)
+
+    # 下载中的任务是否已被暂停或取消
+    def is_stopped(self, history_id):
+        return history_id in self.stopped
+
+    # 下载中的任务被暂停或取消后的状态，未停止时返回None
+    def stopped_status(self, history_id):
+        return self.stopped.get(history_id)
+
+    def pause(self, history_id):
+        self.stop(history_id, STATUS_PAUSED)
+
+    # 取消下载，下载中的任务停止后由下载协程删除临时文件，其他任务立即删除
+    def cancel(self, history_id):
+        with SQLiteDatabase() as db:
+            history = db.query_first_data('cmbok_download_history', {'id': history_id})
+        if not self.stop(history_id, STATUS_CANCELLED) and history is not None and self.cleaner is not None:
+            self.cleaner(history)
+
+    # 停止任务，返回任务是否还在下载中
+    def stop(self, history_id, status):
+        with self.lock:
+            self.waiting.pop(history_id, None)
+            self.relaunch.discard(history_id)
+            running = history_id in self.running
+            if running:
+                self.stopped[history_id] = status
+        self.dispatch()
+        with SQLiteDatabase() as db:
+            db.update_data('cmbok_download_history', {'status': status}, {'id': history_id})
+        return running
+
+    # 继续下载暂停、取消或失败的任务，未完成的部分断点续传
+    def resume(self, history_id):
+        with self.lock:
+            if history_id in self.waiting or (history_id in self.running and history_id not in self.stopped):
+                return
+            # 还在停止中，停止后重新开始
+            deferred = history_id in self.running
+            if deferred:
+                self.relaunch.add(history_id)
+        with SQLiteDatabase() as db:
+            db.update_data('cmbok_download_history', {'status': STATUS_WAITING}, {'id': history_id})
+        if not deferred:
+            self.launch(history_id)
+
+    def set_priority(self, history_id, priority):
+        with SQLiteDatabase() as db:
+            db.update_data('cmbok_download_history', {'priority': priority}, {'id': history_id})
+        with self.lock:
+            if history_id in self.waiting:
+                self.waiting[history_id] = (priority, self.waiting[history_id][1])
+        self.dispatch()
+
+    def launch(self, history_id):
+        with SQLiteDatabase() as db:
+            history = db.query_first_data('cmbok_download_history', {'id': history_id})
+        if history is None or self.launcher is None:
+            return
+        logging.info(f'开始下载任务：{history.name}{history.chapter_name or ""}')
+        self.launcher(history)
+
+    # 启动时继续上次还在等待的任务
+    def resume_waiting(self):
+        with SQLiteDatabase() as db:
+            historys = db.query_data('cmbok_download_history', {'status': STATUS_WAITING}, order_by='id ASC')
+        for history in historys:
+            self.launch(history.id)
+
+
+download_scheduler = DownloadScheduler()
+# 修改同时下载数量后立即分配新的名额
+cfg.downloadThreadNum.valueChanged.connect(lambda value: download_scheduler.dispatch())
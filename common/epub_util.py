@@ -0,0 +1,115 @@
+import logging
+import os
+import zipfile
+from datetime import datetime, timezone
+from html import escape
+
+# 图片扩展名 -> 媒体类型
+IMAGE_MEDIA_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+                     '.gif': 'image/gif', '.webp': 'image/webp'}
+
+CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+PAGE_XHTML = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{language}">
+<head><title>Image {name}</title></head>
+<body><img src="../images/{image}" alt="" /></body>
+</html>
+'''
+
+
+class StreamingEpubWriter:
+    """ 边下载边写入epub：图片按到达顺序直接写入压缩包，页面顺序在关闭时写入OPF，
+    JPEG/PNG等已压缩的图片不再重复压缩 """
+
+    def __init__(self, output_path, identifier, title, author, language='en'):
+        self.output_path = output_path
+        self.identifier = str(identifier)
+        self.title = title
+        self.author = author
+        self.language = language
+        # (序号, 拆分序号) -> (页面名称, 图片文件名)
+        self.pages = {}
+        # 先写入临时文件，完成后再重命名
+        self.temp_path = f'{output_path}.part'
+        self.zip = zipfile.ZipFile(self.temp_path, 'w')
+        # mimetype必须是第一个文件且不压缩
+        self.zip.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr('META-INF/container.xml', CONTAINER_XML, compress_type=zipfile.ZIP_DEFLATED)
+
+    # 写入一页图片，index为页面顺序，part为跨页拆分后的序号，0表示没有拆分
+    def add_image(self, index, data, ext, part=0):
+        ext = ext.lower() if ext.lower() in IMAGE_MEDIA_TYPES else '.jpg'
+        name = f'{index}_{part}' if part else f'{index}'
+        image = f'Cmbok_{name}{ext}'
+        self.zip.writestr(f'EPUB/images/{image}', data, compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr(f'EPUB/pages/page_{name}.xhtml',
+                          PAGE_XHTML.format(language=self.language, name=name, image=image),
+                          compress_type=zipfile.ZIP_DEFLATED)
+        self.pages[(index, part)] = name, image
+
+    # 写入目录和OPF，第一页作为封面
+    def close(self):
+        manifest = []
+        spine = []
+        nav_points = []
+        for order, key in enumerate(sorted(self.pages)):
+            name, image = self.pages[key]
+            properties = ' properties="cover-image"' if order == 0 else ''
+            manifest.append(f'<item id="img_{name}" href="images/{image}" '
+                            f'media-type="{IMAGE_MEDIA_TYPES[os.path.splitext(image)[1]]}"{properties}/>')
+            manifest.append(f'<item id="page_{name}" href="pages/page_{name}.xhtml" '
+                            f'media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="page_{name}"/>')
+            nav_points.append(f'<li><a href="pages/page_{name}.xhtml">Image {name}</a></li>')
+        cover = f'<meta name="cover" content="img_{self.pages[min(self.pages)][0]}"/>' if self.pages else ''
+        title = escape(self.title)
+        # 没有作者时不写入dc:creator，空元素无法通过epubcheck
+        creator = f'<dc:creator>{escape(self.author)}</dc:creator>' if self.author else ''
+        # EPUB 3 必需的最后修改时间，UTC，精确到秒
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        opf = f'''<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">{escape(self.identifier)}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>{self.language}</dc:language>
+    {creator}
+    <meta property="dcterms:modified">{modified}</meta>
+    {cover}
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+    {"".join(manifest)}
+  </manifest>
+  <spine>
+    {"".join(spine)}
+  </spine>
+</package>
+'''
+        nav = f'''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{self.language}">
+<head><title>{title}</title></head>
+<body><nav epub:type="toc" id="toc"><h1>{title}</h1><ol>{"".join(nav_points)}</ol></nav></body>
+</html>
+'''
+        self.zip.writestr('EPUB/nav.xhtml', nav, compress_type=zipfile.ZIP_DEFLATED)
+        self.zip.writestr('EPUB/content.opf', opf, compress_type=zipfile.ZIP_DEFLATED)
+        self.zip.close()
+        os.replace(self.temp_path, self.output_path)
+
+    # 出错时删除未完成的文件
+    def abort(self):
+        self.zip.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            logging.info(f'删除未完成的epub失败: {self.temp_path}')
@@ -0,0 +1,161 @@
+import base64
+import hashlib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 读取文件时的缓冲区大小
+READ_BUFFER_SIZE = 1024 * 1024
+# 整个文件hash提前到达数据的缓存上限
+MAX_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+# 根据hash长度判断算法，无法识别时返回None
+def guess_hash_algorithm(value):
+    if not value or not re.fullmatch(r'[0-9a-fA-F]+', value):
+        return None
+    return {32: 'md5', 40: 'sha1', 64: 'sha256'}.get(len(value))
+
+
+# 校验响应头中的Content-MD5，没有该响应头时返回None
+def check_content_md5(headers, digest):
+    content_md5 = headers.get('Content-MD5')
+    if not content_md5:
+        return None
+    try:
+        return base64.b64decode(content_md5) == digest
+    except ValueError:
+        return None
+
+
+class OrderedHasher:
+    """ 按文件顺序增量计算整个文件的hash，计算和磁盘读取都在单独的线程中执行，不阻塞下载的事件循环：
+    提前到达的数据在内存中缓存，轮到时直接计算，超出缓存上限的部分等区间完成后再从磁盘读取 """
+
+    def __init__(self, algorithm, reader, max_buffer=MAX_BUFFER_SIZE):
+        self.hash = hashlib.new(algorithm)
+        # reader(chunk_start, start, end) 返回分块中指定区间内容的迭代器，为None时数据按顺序到达，不会丢弃
+        self.reader = reader
+        self.max_buffer = max_buffer
+        self.position = 0
+        # 已完成但还未计算的区间 start -> end
+        self.completed = {}
+        # 提前到达还未计算的数据 位置 -> (分块开始位置, 数据)
+        self.pieces = {}
+        # 已提交和缓存还未计算的字节数
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.error = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='OrderedHasher')
+
+    # 分块下载过程中到达的数据，offset为数据在文件中的位置，chunk_start为所属分块
+    def update(self, offset, data, chunk_start=0):
+        with self.lock:
+            if self.reader is not None and self.buffered + len(data) > self.max_buffer:
+                # 超出缓存上限，区间完成后从磁盘读取
+                return
+            self.buffered += len(data)
+        self.submit(self.add_piece, offset, data, chunk_start)
+
+    # 区间下载完成，推进计算位置
+    def complete(self, start, end):
+        self.submit(self.add_range, start, end)
+
+    # 分块下载失败，丢弃还未计算的数据
+    def discard(self, chunk_start):
+        self.submit(self.drop_pieces, chunk_start)
+
+    # 等待所有数据计算完成后返回hash
+    def hexdigest(self):
+        try:
+            file_hash = self.executor.submit(self.hash.hexdigest).result()
+        finally:
+            self.executor.shutdown(wait=False)
+        if self.error is not None:
+            raise self.error
+        return file_hash
+
+    # 放弃计算，释放计算线程和缓存的数据，下载停止或出错时调用，可以重复调用
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pieces = {}
+        self.completed = {}
+        with self.lock:
+            self.buffered = 0
+
+    def submit(self, func, *args):
+        self.executor.submit(self.call, func, *args)
+
+    # 在计算线程中执行，出错后不再计算，hexdigest时抛出
+    def call(self, func, *args):
+        if self.error is not None:
+            return
+        try:
+            func(*args)
+        except Exception as e:
+            self.error = e
+
+    def add_piece(self, offset, data, chunk_start):
+        if offset < self.position:
+            # 已经计算过的部分
+            self.release(min(self.position - offset, len(data)))
+            data = data[self.position - offset:]
+            offset = self.position
+        if data:
+            self.pieces[offset] = (chunk_start, data)
+            self.advance()
+
+    def add_range(self, start, end):
+        self.completed[start] = end
+        self.advance()
+
+    def drop_pieces(self, chunk_start):
+        for offset in [offset for offset, piece in self.pieces.items() if piece[0] == chunk_start]:
+            self.release(len(self.pieces.pop(offset)[1]))
+
+    def release(self, size):
+        with self.lock:
+            self.buffered -= size
+
+    def advance(self):
+        while True:
+            piece = self.pieces.pop(self.position, None)
+            if piece is not None:
+                self.hash.update(piece[1])
+                self.position += len(piece[1])
+                self.release(len(piece[1]))
+                continue
+            chunk_start = self.completed_range()
+            if chunk_start is None:
+                break
+            # 没有缓存的部分从磁盘读取，直到下一段缓存的数据
+            end = self.completed[chunk_start]
+            stop = min([offset for offset in self.pieces if self.position < offset <= end], default=end + 1) - 1
+            for data in self.reader(chunk_start, self.position, stop):
+                self.hash.update(data)
+            self.position = stop + 1
+        # 丢弃落后于计算位置的数据
+        for offset in [offset for offset in self.pieces if offset < self.position]:
+            self.release(len(self.pieces.pop(offset)[1]))
+
+    # 包含当前计算位置的已完成区间，返回区间开始位置，同时清除已计算完的区间
+    def completed_range(self):
+        for start, end in list(self.completed.items()):
+            if end < self.position:
+                del self.completed[start]
+            elif start <= self.position:
+                return start
+        return None
+
+
+# 按区间读取文件内容，offset为文件开头对应的位置
+def read_file_range(file_path, start, end, offset=0):
+    with open(file_path, 'rb') as f:
+        f.seek(start - offset)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(READ_BUFFER_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
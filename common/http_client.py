@@ -0,0 +1,37 @@
+import asyncio
+import weakref
+
+import aiohttp
+
+# 连接池总连接数
+CONNECTION_LIMIT = 64
+# 每个域名的连接数
+CONNECTION_LIMIT_PER_HOST = 16
+# DNS缓存时间（秒）
+DNS_CACHE_TTL = 300
+# 空闲连接保持时间（秒）
+KEEPALIVE_TIMEOUT = 30
+
+# 每个事件循环共享一个客户端
+_sessions = weakref.WeakKeyDictionary()
+
+
+# 获取当前事件循环共享的连接池客户端，复用TCP和TLS连接
+def get_session():
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                                         ttl_dns_cache=DNS_CACHE_TTL, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector,
+                                        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30))
+        _sessions[loop] = session
+    return session
+
+
+# 关闭当前事件循环的客户端
+async def close_session():
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import traceback
+
+from common.progress_writer import progress_writer
+from common.sqlite_util import SQLiteDatabase
+
+# 缓存目录
+CACHE_FOLDER = 'app/image_cache'
+# 计算hash时的读取缓冲区大小
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+class ImageCache:
+    """ 按内容寻址的图片缓存：图片url -> 内容hash -> 缓存文件，
+    相同内容只保存一份，通过硬链接放入章节目录，超出容量时按最近使用时间淘汰 """
+
+    def __init__(self, folder=CACHE_FOLDER, limit=0):
+        self.folder = folder
+        # 缓存容量（字节），0表示不使用缓存
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.loaded = False
+        # 图片url -> 内容hash
+        self.urls = {}
+        # 内容hash -> [大小, 最近使用时间]
+        self.objects = {}
+        self.total = 0
+
+    def set_limit(self, limit):
+        with self.lock:
+            self.limit = limit
+            if self.loaded:
+                self.evict()
+
+    # 首次使用时从数据库加载索引
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        with SQLiteDatabase() as db:
+            for row in db.query_data('cmbok_image_cache'):
+                self.urls[row.url] = row.content_hash
+                if row.content_hash not in self.objects:
+                    self.objects[row.content_hash] = [row.size, row.last_access]
+                    self.total += row.size
+
+    def object_path(self, content_hash):
+        return os.path.join(self.folder, content_hash[:2], content_hash)
+
+    # 查找url对应的缓存文件，更新最近使用时间，没有缓存时返回None
+    def lookup(self, url):
+        with self.lock:
+            if not self.limit:
+                return None
+            self.load()
+            content_hash = self.urls.get(url)
+            if content_hash is None or content_hash not in self.objects:
+                return None
+            path = self.object_path(content_hash)
+            if not os.path.isfile(path):
+                # 缓存文件被删除，清除索引
+                self.remove(content_hash)
+                return None
+            now = time.time()
+            self.objects[content_hash][1] = now
+            progress_writer.execute('UPDATE cmbok_image_cache SET last_access = ? WHERE content_hash = ?;',
+                                    (now, content_hash))
+            return path
+
+    # 缓存命中时把图片链接到目标路径，返回是否命中
+    def link(self, url, target_path):
+        path = self.lookup(url)
+        if path is None:
+            return False
+        try:
+            link_file(path, target_path)
+            return True
+        except OSError:
+            logging.info(traceback.format_exc())
+            return False
+
+    # 缓存命中时返回图片内容
+    def read(self, url):
+        path = self.lookup(url)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    # 把下载完成的图片文件加入缓存，内容已缓存时改为链接到缓存文件
+    def store(self, url, file_path):
+        if not self.limit:
+            return
+        content_hash = hash_file(file_path)
+        path = self.object_path(content_hash)
+        with self.lock:
+            self.load()
+            try:
+                if content_hash in self.objects and os.path.isfile(path):
+                    # 相同内容已缓存，替换为硬链接，只占用一份空间
+                    link_file(path, file_path)
+                else:
+                    link_file(file_path, path)
+                self.add(url, content_hash, os.path.getsize(path))
+            except OSError:
+                logging.info(traceback.format_exc())
+                logging.info(f'缓存图片失败：{url}')
+
+    # 把下载的图片内容加入缓存
+    def store_data(self, url, data):
+        if not self.limit:
+            return
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self.object_path(content_hash)
+        with self.lock:
+            self.load()
+            try:
+                if content_hash not in self.objects or not os.path.isfile(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(f'{path}.part', 'wb') as f:
+                        f.write(data)
+                    os.replace(f'{path}.part', path)
+                self.add(url, content_hash, len(data))
+            except OSError:
+                logging.info(traceback.format_exc())
+                logging.info(f'缓存图片失败：{url}')
+
+    def add(self, url, content_hash, size):
+        now = time.time()
+        if content_hash not in self.objects:
+            self.objects[content_hash] = [size, now]
+            self.total += size
+        else:
+            self.objects[content_hash][1] = now
+        if self.urls.get(url) != content_hash:
+            self.urls[url] = content_hash
+            progress_writer.execute('DELETE FROM cmbok_image_cache WHERE url = ?;', (url,))
+            progress_writer.insert('cmbok_image_cache', {'url': url, 'content_hash': content_hash,
+                                                         'size': size, 'last_access': now})
+        self.evict()
+
+    # 超出容量时删除最久未使用的缓存文件
+    def evict(self):
+        if self.total <= self.limit:
+            return
+        for content_hash, (size, last_access) in sorted(self.objects.items(), key=lambda item: item[1][1]):
+            if self.total <= self.limit:
+                break
+            self.remove(content_hash)
+
+    def remove(self, content_hash):
+        size, last_access = self.objects.pop(content_hash, (0, 0))
+        self.total -= size
+        for url in [url for url, value in self.urls.items() if value == content_hash]:
+            del self.urls[url]
+        progress_writer.execute('DELETE FROM cmbok_image_cache WHERE content_hash = ?;', (content_hash,))
+        try:
+            os.remove(self.object_path(content_hash))
+        except OSError:
+            pass
+
+
+# 计算文件的sha256
+def hash_file(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(READ_BUFFER_SIZE)
+            if not data:
+                break
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+# 创建硬链接，目标已存在时替换，不支持硬链接时复制
+def link_file(source, target):
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    temp_path = f'{target}.link'
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, target)
+
+
+image_cache = ImageCache()
@@ -0,0 +1,129 @@
+import asyncio
+import time
+from collections import deque
+
+from common.retry_util import RetryPolicy
+
+
+class ChapterJob:
+    """ 一个章节的图片下载任务 """
+
+    # finished_pages 上次已下载完成的页面 序号 -> 大小，processed 上次已裁剪、转码的页面序号
+    def __init__(self, history_id, chapter_name, image_urls, path, finished_pages=None, processed=None):
+        finished_pages = finished_pages or {}
+        self.history_id = history_id
+        self.chapter_name = chapter_name
+        # 图片保存目录
+        self.path = path
+        # 边下载边写入的epub/cbz，为空时先保存图片再打包
+        self.writers = []
+        # 页面整理参数（裁剪白边、拆分跨页），为None时不处理
+        self.cleanup = None
+        # 转码参数 (设备参数, 图片质量)，为None时不转码
+        self.transcode = None
+        # 已裁剪、转码的页面序号，后期处理时跳过
+        self.processed = set(processed or ())
+        # 所属漫画 (漫画id, 漫画名称, 漫画作者)
+        self.comic = None
+        # 重试策略，整个章节共享重试次数上限
+        self.retry_policy = RetryPolicy(budget=max(20, len(image_urls)))
+        # 待下载的 (序号, 图片url)
+        self.pending = deque((index, url) for index, url in enumerate(image_urls) if index not in finished_pages)
+        self.total = len(image_urls)
+        # 已结束的图片数量（成功或失败）
+        self.finished = len(finished_pages)
+        # 下载失败、等待重试的 (序号, 图片url)
+        self.failed = []
+        # 无法重试的失败图片数量（如404）
+        self.lost = 0
+        # 已进行的重试轮数
+        self.retry_rounds = 0
+        self.retry_task = None
+        # 已知的图片大小 序号 -> 字节数，来自页面清单或响应头
+        self.sizes = dict(finished_pages)
+        # 已完成图片的字节数
+        self.done_bytes = sum(finished_pages.values())
+        # 下载中的图片已接收的字节数 序号 -> 字节数
+        self.in_flight = {}
+        # 下载进度
+        self.process = self.percent()
+        # 开始下载的时间
+        self.start_time = time.monotonic()
+        # 章节全部图片结束时完成
+        self.done = asyncio.get_running_loop().create_future()
+
+    # 开始接收图片，size为响应头中的文件大小
+    def start_page(self, index, size):
+        self.in_flight[index] = 0
+        if size:
+            self.sizes[index] = size
+
+    def add_bytes(self, index, count):
+        self.in_flight[index] = self.in_flight.get(index, 0) + count
+
+    def finish_page(self, index, size):
+        self.in_flight.pop(index, None)
+        self.sizes[index] = size
+        self.done_bytes += size
+
+    def fail_page(self, index):
+        self.in_flight.pop(index, None)
+
+    # 已接收的字节数，包括下载中的图片
+    def received(self):
+        return self.done_bytes + sum(self.in_flight.values())
+
+    # 未知大小的图片按已知图片的平均大小估算章节总字节数，没有已知大小时为0
+    def estimated_size(self):
+        if not self.sizes:
+            return 0
+        known = sum(self.sizes.values())
+        return known + known / len(self.sizes) * (self.total - len(self.sizes))
+
+    # 按已接收字节数估算进度，打包完成前最多99
+    def percent(self):
+        if not self.total:
+            return 0
+        if not self.sizes:
+            return int(self.finished * 100 / self.total)
+        estimate = self.estimated_size()
+        return min(int(self.received() * 100 / estimate), 99) if estimate else 0
+
+    # 已分配给下载协程的图片比例
+    def dispatched_ratio(self):
+        return (self.total - len(self.pending)) / self.total if self.total else 1
+
+
+class ChapterJobQueue:
+    """ 所有漫画章节共享的图片任务队列，空闲的下载协程优先从进度最落后的章节取任务 """
+
+    def __init__(self):
+        self.jobs = []
+        self.closed = False
+        self.condition = asyncio.Condition()
+
+    async def put(self, job):
+        async with self.condition:
+            self.jobs.append(job)
+            self.condition.notify_all()
+
+    # 取出一个图片任务，队列关闭且没有任务时返回None
+    async def get(self):
+        async with self.condition:
+            while True:
+                jobs = [job for job in self.jobs if job.pending]
+                if jobs:
+                    # 已分配比例最低的章节，相同时先加入的优先
+                    job = min(jobs, key=lambda j: (j.dispatched_ratio(), self.jobs.index(j)))
+                    index, url = job.pending.popleft()
+                    if not job.pending:
+                        self.jobs.remove(job)
+                    return job, index, url
+                if self.closed:
+                    return None
+                await self.condition.wait()
+
+    async def close(self):
+        async with self.condition:
+            self.closed = True
+            self.condition.notify_all()
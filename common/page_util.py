@@ -0,0 +1,113 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# 分析页面时缩小到的最大边长
+ANALYZE_SIZE = 512
+# 灰度大于该值视为白边
+WHITE_THRESHOLD = 235
+# 一行（列）中非白色像素超过该比例才算内容，忽略扫描噪点
+CONTENT_RATIO = 0.005
+# 裁剪后保留的边距比例
+CROP_PADDING = 0.01
+# 宽高比超过该值视为跨页
+SPREAD_RATIO = 1.0
+# 裁剪、拆分后重新保存的JPEG质量
+SAVE_QUALITY = 95
+
+
+# 在缩小的灰度图上查找内容区域，返回原图上的 (左, 上, 右, 下)，没有白边时返回None
+def find_content_box(img):
+    width, height = img.size
+    small = img.convert('L')
+    small.thumbnail((ANALYZE_SIZE, ANALYZE_SIZE))
+    mask = np.asarray(small) < WHITE_THRESHOLD
+    rows = np.flatnonzero(mask.mean(axis=1) > CONTENT_RATIO)
+    cols = np.flatnonzero(mask.mean(axis=0) > CONTENT_RATIO)
+    # 空白页不裁剪
+    if rows.size == 0 or cols.size == 0:
+        return None
+    scale_x = width / small.width
+    scale_y = height / small.height
+    pad_x = int(width * CROP_PADDING)
+    pad_y = int(height * CROP_PADDING)
+    box = (max(int(cols[0] * scale_x) - pad_x, 0),
+           max(int(rows[0] * scale_y) - pad_y, 0),
+           min(int((cols[-1] + 1) * scale_x) + pad_x, width),
+           min(int((rows[-1] + 1) * scale_y) + pad_y, height))
+    if box == (0, 0, width, height):
+        return None
+    return box
+
+
+# 整理一页：横向跨页拆分为两页，再裁剪白边，返回页面列表，没有变化时返回None
+# options: crop 是否裁剪白边，split 是否拆分跨页，right_first 拆分后右半页在前（漫画从右往左阅读）
+def clean_page(img, options):
+    img = ImageOps.exif_transpose(img)
+    changed = False
+    pages = [img]
+    if options['split'] and img.width > img.height * SPREAD_RATIO:
+        middle = img.width // 2
+        left = img.crop((0, 0, middle, img.height))
+        right = img.crop((middle, 0, img.width, img.height))
+        pages = [right, left] if options['right_first'] else [left, right]
+        changed = True
+    if options['crop']:
+        for index, page in enumerate(pages):
+            box = find_content_box(page)
+            if box is not None:
+                pages[index] = page.crop(box)
+                changed = True
+    return pages if changed else None
+
+
+def save_page(img, file, ext):
+    if ext.lower() == '.png':
+        img.save(file, 'PNG')
+    elif ext.lower() == '.webp':
+        img.save(file, 'WEBP', quality=SAVE_QUALITY)
+    else:
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(file, 'JPEG', quality=SAVE_QUALITY)
+
+
+# 整理一批图片文件，在子进程中执行：拆分的页面保存为 原文件名_1、原文件名_2，自然排序后顺序不变
+# 返回 (裁剪或拆分的页面数, 拆分的页面数)
+def clean_page_files(file_paths, options):
+    changed = 0
+    split = 0
+    for file_path in file_paths:
+        with Image.open(file_path) as img:
+            pages = clean_page(img, options)
+            if pages is None:
+                continue
+            for page in pages:
+                page.load()
+        changed += 1
+        base, ext = os.path.splitext(file_path)
+        if len(pages) == 1:
+            save_page(pages[0], f'{base}.part{ext}', ext)
+            os.replace(f'{base}.part{ext}', file_path)
+            continue
+        split += 1
+        for part, page in enumerate(pages, 1):
+            save_page(page, f'{base}_{part}{ext}', ext)
+        os.remove(file_path)
+    return changed, split
+
+
+# 整理单张图片内容，在子进程中执行，返回页面内容列表
+def clean_page_data(data, ext, options):
+    with Image.open(io.BytesIO(data)) as img:
+        pages = clean_page(img, options)
+        if pages is None:
+            return [data]
+        result = []
+        for page in pages:
+            output = io.BytesIO()
+            save_page(page, output, ext)
+            result.append(output.getvalue())
+        return result
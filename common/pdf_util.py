@@ -0,0 +1,109 @@
+import io
+import logging
+import os
+import shutil
+
+from PIL import Image
+
+# 直接嵌入的JPEG颜色模式
+JPEG_COLOR_SPACES = {'RGB': '/DeviceRGB', 'L': '/DeviceGray'}
+# 复制图片数据时的缓冲区大小
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class StreamingPdfWriter:
+    """ 逐页写入PDF，同一时间最多只解码一张图片：
+    JPEG图片直接嵌入原始数据，其他格式转换为RGB后编码为JPEG """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.file = open(output_path, 'wb')
+        # 对象编号 -> 文件中的位置，1为Catalog，2为Pages
+        self.offsets = {}
+        self.next_id = 3
+        self.page_ids = []
+        self.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        self.file.write(data)
+
+    def allocate(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def begin_object(self, obj_id):
+        self.offsets[obj_id] = self.file.tell()
+        self.write(f'{obj_id} 0 obj\n')
+
+    def write_object(self, obj_id, body):
+        self.begin_object(obj_id)
+        self.write(f'{body}\nendobj\n')
+
+    # 添加一页，页面尺寸与图片像素一致
+    def add_image(self, image_path):
+        with Image.open(image_path) as img:
+            width, height = img.size
+            color_space = JPEG_COLOR_SPACES.get(img.mode)
+            if img.format == 'JPEG' and color_space:
+                # 只读取了文件头，直接复制原始JPEG数据
+                length = os.path.getsize(image_path)
+                with open(image_path, 'rb') as f:
+                    self.add_page(width, height, color_space, length, f)
+                return
+            # 其他格式需要解码，转换为 RGB 模式（PDF 需要 RGB 模式）
+            buffer = io.BytesIO()
+            img.convert('RGB').save(buffer, 'JPEG')
+        length = buffer.tell()
+        buffer.seek(0)
+        self.add_page(width, height, '/DeviceRGB', length, buffer)
+
+    def add_page(self, width, height, color_space, length, stream):
+        image_id = self.allocate()
+        self.begin_object(image_id)
+        self.write(f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+                   f'/ColorSpace {color_space} /BitsPerComponent 8 /Filter /DCTDecode '
+                   f'/Length {length} >>\nstream\n')
+        shutil.copyfileobj(stream, self.file, COPY_BUFFER_SIZE)
+        self.write('\nendstream\nendobj\n')
+
+        content = f'q {width} 0 0 {height} 0 0 cm /Im0 Do Q'
+        content_id = self.allocate()
+        self.write_object(content_id, f'<< /Length {len(content)} >>\nstream\n{content}\nendstream')
+
+        page_id = self.allocate()
+        self.write_object(page_id, f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] '
+                                   f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> '
+                                   f'/Contents {content_id} 0 R >>')
+        self.page_ids.append(page_id)
+
+    # 写入页面目录和交叉引用表
+    def close(self):
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self.page_ids)
+        self.write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>')
+        self.write_object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        xref_offset = self.file.tell()
+        self.write(f'xref\n0 {self.next_id}\n0000000000 65535 f \n')
+        for obj_id in range(1, self.next_id):
+            self.write(f'{self.offsets[obj_id]:010d} 00000 n \n')
+        self.write(f'trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n')
+        self.file.close()
+
+    # 出错时删除未完成的文件
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.output_path)
+        except OSError:
+            logging.info(f'删除未完成的PDF失败: {self.output_path}')
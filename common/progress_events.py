@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+# 每个下载任务每秒最多通知界面的次数
+UPDATES_PER_SECOND = 4
+# 下载速度的平滑系数，越大越接近当前速度
+SPEED_SMOOTHING = 0.3
+# 超过该时间（秒）没有上报的任务不再保留速度统计
+RATE_EXPIRE = 60
+
+# 下载任务的进度快照 type 类型（1：漫画 2：图书） process 进度 speed 速度（字节/秒） eta 预计剩余秒数，未知时为None
+ProgressSnapshot = namedtuple('ProgressSnapshot', ['type', 'process', 'speed', 'eta'])
+
+
+class ProgressEvents:
+    """ 下载进度和状态事件合并通知：下载协程随时上报，后台线程按固定间隔把有变化的任务打包成一次通知，
+    同一任务在间隔内的多次上报只保留最后一次 """
+
+    def __init__(self, updates_per_second=UPDATES_PER_SECOND):
+        self.interval = 1 / updates_per_second
+        self.lock = threading.Lock()
+        self.thread = None
+        # 下载记录id -> (类型, 进度, 已接收字节数, 总字节数)
+        self.progress = {}
+        # 下载记录id -> (统计时间, 已接收字节数, 速度)
+        self.rates = {}
+        # 下载状态事件 (状态, 名称, 章节名称, 类型)
+        self.events = []
+        # listener({下载记录id: ProgressSnapshot}, [状态事件])
+        self.listener = None
+
+    def set_listener(self, listener):
+        self.listener = listener
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='ProgressEvents', daemon=True)
+                self.thread.start()
+
+    # 上报下载进度，total未知时为0
+    def report(self, history_id, type, process, received=0, total=0):
+        self.start()
+        with self.lock:
+            self.progress[history_id] = (type, process, received, total)
+
+    # 上报下载状态变化（开始、完成、失败）
+    def notify(self, status, name, chapter_name, type):
+        self.start()
+        with self.lock:
+            self.events.append((status, name, chapter_name, type))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.info(traceback.format_exc())
+                logging.info('通知下载进度异常')
+
+    # 把间隔内的进度和事件打包通知一次
+    def flush(self):
+        with self.lock:
+            progress, self.progress = self.progress, {}
+            events, self.events = self.events, []
+        if not progress and not events:
+            return
+        now = time.monotonic()
+        snapshots = {history_id: self.snapshot(now, history_id, *value) for history_id, value in progress.items()}
+        for history_id in [key for key, value in self.rates.items() if now - value[0] > RATE_EXPIRE]:
+            del self.rates[history_id]
+        if self.listener is not None:
+            self.listener(snapshots, events)
+
+    # 按两次上报之间的字节数计算平滑后的速度和预计剩余时间
+    def snapshot(self, now, history_id, type, process, received, total):
+        last_time, last_received, speed = self.rates.get(history_id, (now, received, 0))
+        if now > last_time:
+            current = max(received - last_received, 0) / (now - last_time)
+            speed = current if not speed else speed * (1 - SPEED_SMOOTHING) + current * SPEED_SMOOTHING
+        self.rates[history_id] = (now, received, speed)
+        eta = round((total - received) / speed) if speed and total > received else None
+        return ProgressSnapshot(type, process, int(speed), eta)
+
+
+progress_events = ProgressEvents()
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+import traceback
+
+from common.sqlite_util import SQLiteDatabase
+
+
+class ProgressWriter:
+    """ 下载进度单线程写入：同一下载记录的多次更新合并，按时间间隔批量提交 """
+
+    def __init__(self, interval=0.5):
+        # 批量提交间隔（秒）
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='ProgressWriter', daemon=True)
+                self.thread.start()
+
+    # 更新下载记录，同一记录只保留最后的值
+    def update(self, history_id, data):
+        self.start()
+        self.queue.put(('update', history_id, data))
+
+    # 插入数据，按顺序写入
+    def insert(self, table_name, data):
+        self.start()
+        self.queue.put(('insert', table_name, data))
+
+    # 执行SQL语句，和插入数据一起按顺序写入
+    def execute(self, sql, params=()):
+        self.start()
+        self.queue.put(('execute', sql, params))
+
+    # 等待已提交的数据全部写入，阻塞当前线程，不能在事件循环中调用
+    def flush(self, timeout=10):
+        self.start()
+        event = threading.Event()
+        self.queue.put(('flush', event.set, None))
+        event.wait(timeout)
+
+    # 在事件循环中等待已提交的数据全部写入，不阻塞其他下载协程
+    async def flush_async(self, timeout=10):
+        self.start()
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        self.queue.put(('flush', lambda: loop.call_soon_threadsafe(event.set), None))
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.info('等待写入下载进度超时')
+
+    def run(self):
+        sqlite_util = SQLiteDatabase()
+        updates = {}
+        inserts = []
+        # 写入完成后的通知
+        callbacks = []
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    action, key, data = self.queue.get(timeout=timeout)
+                    if action == 'update':
+                        updates.setdefault(key, {}).update(data)
+                    elif action in ('insert', 'execute'):
+                        inserts.append((action, key, data))
+                    else:
+                        callbacks.append(key)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.interval
+                    if not callbacks:
+                        continue
+                except queue.Empty:
+                    pass
+                self.write(sqlite_util, inserts, updates)
+                for callback in callbacks:
+                    try:
+                        callback()
+                    except Exception:
+                        logging.info(traceback.format_exc())
+                updates = {}
+                inserts = []
+                callbacks = []
+                deadline = None
+        finally:
+            sqlite_util.close()
+
+    # 在一个事务中写入所有数据
+    def write(self, sqlite_util, inserts, updates):
+        try:
+            sqlite_util.cursor.execute('BEGIN;')
+            for action, key, data in inserts:
+                self.write_statement(sqlite_util, action, key, data)
+            for history_id, data in updates.items():
+                self.write_statement(sqlite_util, 'update', history_id, data)
+            sqlite_util.commit()
+        except Exception:
+            sqlite_util.rollback()
+            logging.info(traceback.format_exc())
+            logging.info('保存下载进度异常')
+
+    # 在保存点中执行一条语句，失败时只回滚该语句，不影响同一批次的其他数据
+    def write_statement(self, sqlite_util, action, key, data):
+        sqlite_util.cursor.execute('SAVEPOINT progress;')
+        try:
+            if action == 'update':
+                sqlite_util.update_data('cmbok_download_history', data, {'id': key}, commit=False)
+            elif action == 'insert':
+                sqlite_util.insert_data(key, data, commit=False)
+            else:
+                sqlite_util.cursor.execute(key, data)
+        except Exception:
+            sqlite_util.cursor.execute('ROLLBACK TO progress;')
+            logging.info(traceback.format_exc())
+            logging.info(f'保存下载进度异常: {key}')
+        sqlite_util.cursor.execute('RELEASE progress;')
+
+
+progress_writer = ProgressWriter()
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+import time
+
+# 最小桶容量，保证一个读缓冲区可以通过
+MIN_CAPACITY = 64 * 1024
+
+
+class TokenBucket:
+    """ 异步令牌桶限速，线程安全，速率可在运行时修改 """
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.capacity = MIN_CAPACITY
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.set_rate(rate)
+
+    # 设置速率（字节/秒），0表示不限速
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = max(int(rate), 0)
+            # 最多允许1秒的突发流量
+            self.capacity = max(self.rate, MIN_CAPACITY)
+            self.tokens = min(self.tokens, self.capacity)
+            self.last = time.monotonic()
+
+    # 消耗size字节的令牌，不足时让出事件循环等待
+    async def consume(self, size):
+        while True:
+            with self.lock:
+                if self.rate <= 0:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                # 超过桶容量的请求在桶满时放行，允许令牌变为负数
+                need = min(size, self.capacity)
+                if self.tokens >= need:
+                    self.tokens -= size
+                    return
+                wait = (need - self.tokens) / self.rate
+            # 分段等待，速率修改后尽快生效
+            await asyncio.sleep(min(wait, 0.5))
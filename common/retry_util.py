@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import random
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import aiohttp
+
+# 除5xx外可重试的HTTP状态码
+RETRYABLE_STATUS = {408, 425, 429}
+
+
+# 判断HTTP状态码是否可重试：所有5xx以及请求超时、过早、过多请求
+def is_retryable_status(status):
+    return 500 <= status < 600 or status in RETRYABLE_STATUS
+
+
+class FatalDownloadError(Exception):
+    """ 不可重试的下载错误，如404、416 """
+
+
+class RetryBudgetExhausted(Exception):
+    """ 整个下载的重试次数已用完 """
+
+
+# 解析Retry-After响应头，返回等待秒数
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(value)
+        if retry_time.tzinfo is None:
+            retry_time = retry_time.replace(tzinfo=timezone.utc)
+        return max((retry_time - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """ 异步重试策略：指数退避加随机抖动，整个下载共享重试次数上限 """
+
+    def __init__(self, budget=50, base_delay=1.0, max_delay=60.0, max_attempts=10):
+        # 整个下载允许的重试总次数
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # 单个请求的最大尝试次数
+        self.max_attempts = max_attempts
+        self.retries = 0
+
+    # 判断异常是否可重试，返回(是否可重试, 服务器要求的等待秒数)
+    def classify(self, e):
+        if isinstance(e, (FatalDownloadError, RetryBudgetExhausted)):
+            return False, None
+        if isinstance(e, aiohttp.ClientResponseError):
+            if is_retryable_status(e.status):
+                retry_after = parse_retry_after(e.headers.get('Retry-After')) if e.headers else None
+                return True, retry_after
+            return False, None
+        if isinstance(e, (asyncio.TimeoutError, aiohttp.ClientError, ConnectionError)):
+            return True, None
+        return False, None
+
+    # 第attempt次重试的等待时间，全抖动
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    # 执行异步函数，失败时按策略等待重试，不阻塞事件循环
+    async def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                retryable, retry_after = self.classify(e)
+                if not retryable:
+                    raise
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    logging.info('达到最大重试次数，下载失败。')
+                    raise
+                if self.retries >= self.budget:
+                    raise RetryBudgetExhausted(f'重试次数已用完: {e}') from e
+                self.retries += 1
+                delay = self.backoff(attempt, retry_after)
+                logging.info(f'下载过程中出现错误: {e!r}，{delay:.1f}秒后重试 (尝试次数: {attempt})')
+                await asyncio.sleep(delay)
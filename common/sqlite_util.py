@@ -45,7 +45,7 @@ class SQLiteDatabase:
             # chapter_path_word 章节key 只有漫画有
             # book_hash 图书hash
             # type 类型。1：漫画 2：图书
-            # status 状态：-3：软件退出 -2：无法下载 -1：转换epub失败 1：下载中 2：等待中 3：已完成 0：下载失败
+            # status 状态：-5：已取消 -4：页面缺失（重试后仍有图片失败，已打包） -3：软件退出 -2：无法下载 -1：转换epub失败 1：下载中 2：等待中 3：已完成 4：已暂停 0：下载失败
             # process 进度
             # start_time 开始时间
             # finish_time 完成时间
@@ -68,7 +68,59 @@ class SQLiteDatabase:
                               {'id': 'INTEGER PRIMARY KEY', 'cover': 'TEXT', 'name': 'TEXT',
                                'author': 'TEXT', 'key': 'TEXT', 'book_hash': 'TEXT', 'book_extension': 'TEXT',
                                'type': 'INTEGER', 'collection_time': 'TEXT'})
-            self.close()
+
+        # 创建图书分块下载清单表，记录已完成的字节区间，用于断点续传
+        # key 图书book_id
+        # book_hash 图书hash
+        # file_size 文件大小，大小变化时清单作废
+        # start 区间起始字节
+        # end 区间结束字节（包含）
+        # history_id 下载记录id
+        self.create_table('cmbok_download_chunk',
+                          {'id': 'INTEGER PRIMARY KEY', 'key': 'TEXT', 'book_hash': 'TEXT',
+                           'file_size': 'INTEGER', 'start': 'INTEGER', 'end': 'INTEGER',
+                           'history_id': 'INTEGER'})
+
+        # 创建漫画章节页面清单表，用于断点续传
+        # history_id 下载记录id
+        # page_index 页面序号
+        # url 图片url
+        # size 图片大小
+        # state 状态：-1：下载失败 0：未下载 1：已完成
+        self.create_table('cmbok_download_page',
+                          {'id': 'INTEGER PRIMARY KEY', 'history_id': 'INTEGER', 'page_index': 'INTEGER',
+                           'url': 'TEXT', 'size': 'INTEGER', 'state': 'INTEGER'})
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_download_page_history "
+                            "ON cmbok_download_page (history_id, page_index);")
+
+        # 创建图片缓存索引表，相同内容的图片只缓存一份
+        # url 图片url
+        # content_hash 图片内容sha256，缓存文件名
+        # size 图片大小
+        # last_access 最近使用时间，超出缓存容量时按此淘汰
+        self.create_table('cmbok_image_cache',
+                          {'id': 'INTEGER PRIMARY KEY', 'url': 'TEXT', 'content_hash': 'TEXT',
+                           'size': 'INTEGER', 'last_access': 'REAL'})
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_url ON cmbok_image_cache (url);")
+
+        # 下载记录新增字段
+        # transfer_info 图书下载自适应选择的分块大小、并发数等参数（JSON）
+        self.add_column('cmbok_download_history', 'transfer_info', 'TEXT')
+        # stage_info 漫画章节后期处理的排队数量和各阶段耗时（JSON）
+        self.add_column('cmbok_download_history', 'stage_info', 'TEXT')
+        # priority 下载优先级，越大越先下载
+        self.add_column('cmbok_download_history', 'priority', 'INTEGER')
+        # payload 重新开始下载需要的其他参数，如图书扩展名（JSON）
+        self.add_column('cmbok_download_history', 'payload', 'TEXT')
+        # 分块清单新增字段
+        # chunk_hash 分块md5
+        # verified 分块是否经过服务器Content-MD5校验
+        self.add_column('cmbok_download_chunk', 'chunk_hash', 'TEXT')
+        self.add_column('cmbok_download_chunk', 'verified', 'INTEGER')
+        # 页面清单新增字段
+        # processed 页面是否已经裁剪、转码，继续下载时不再重复处理
+        self.add_column('cmbok_download_page', 'processed', 'INTEGER')
+        self.close()
 
     def create_table(self, table_name, columns):
         """创建表"""
@@ -77,13 +129,21 @@ class SQLiteDatabase:
         self.cursor.execute(sql)
         self.connection.commit()
 
-    def insert_data(self, table_name, data):
-        """插入数据"""
+    def add_column(self, table_name, column, col_type):
+        """添加字段，字段已存在时跳过"""
+        columns = [row[1] for row in self.cursor.execute(f"PRAGMA table_info({table_name});").fetchall()]
+        if column not in columns:
+            self.cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {col_type};")
+            self.connection.commit()
+
+    def insert_data(self, table_name, data, commit=True):
+        """插入数据，commit为False时由调用方统一提交"""
         columns = ', '.join(data.keys())
         placeholders = ', '.join('?' * len(data))
         sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders});"
         self.cursor.execute(sql, tuple(data.values()))
-        self.connection.commit()
+        if commit:
+            self.connection.commit()
         return self.cursor.lastrowid  # 返回插入后的 ID
 
     def query_data(self, table_name, conditions=None, order_by=None, limit=None, offset=None):
@@ -150,13 +210,14 @@ class SQLiteDatabase:
         sql += ";"
         return self.cursor.execute(sql, params).fetchone()[0]  # 返回计数结果
 
-    def update_data(self, table_name, data, conditions):
-        """更新数据"""
+    def update_data(self, table_name, data, conditions, commit=True):
+        """更新数据，commit为False时由调用方统一提交"""
         set_str = ', '.join([f"{key} = ?" for key in data.keys()])
         condition_str = ' AND '.join([f"{key} = ?" for key in conditions.keys()])
         sql = f"UPDATE {table_name} SET {set_str} WHERE {condition_str};"
         self.cursor.execute(sql, tuple(data.values()) + tuple(conditions.values()))
-        self.connection.commit()
+        if commit:
+            self.connection.commit()
 
     def delete_data(self, table_name, conditions):
         """删除数据"""
@@ -166,6 +227,7 @@ class SQLiteDatabase:
         self.connection.commit()
 
     def delErrorRecord(self, table_name):
+        """删除失败记录，包括页面缺失（-4）和已取消（-5）的记录"""
         sql = f"DELETE FROM {table_name} WHERE status<=0;"
         self.cursor.execute(sql)
         self.connection.commit()
@@ -174,6 +236,10 @@ class SQLiteDatabase:
         """关闭数据库连接"""
         self.connection.close()
 
+    def commit(self):
+        """提交事务"""
+        self.connection.commit()
+
     def rollback(self):
         """回滚事务"""
         self.connection.rollback()
@@ -0,0 +1,62 @@
+import asyncio
+
+# 读写缓冲区大小
+BUFFER_SIZE = 64 * 1024
+# 全局在途字节上限
+MAX_IN_FLIGHT_BYTES = 16 * 1024 * 1024
+
+
+class ByteBudget:
+    """ 全局在途字节上限：按每次读取的数据长度计算已读取还未写入的字节数，
+    超出上限的读取等待其他数据写入后被唤醒，在共享的下载事件循环中使用 """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.loop = None
+        self.condition = None
+
+    # 当前事件循环的条件变量，下载事件循环重新启动后重新创建
+    def get_condition(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.condition = asyncio.Condition()
+            self.in_use = 0
+        return self.condition
+
+    # 申请额度，超出上限时等待释放
+    async def acquire(self, size):
+        condition = self.get_condition()
+        async with condition:
+            # 没有占用时总是放行，避免单次读取超过上限时永远等待
+            await condition.wait_for(lambda: self.in_use == 0 or self.in_use + size <= self.limit)
+            self.in_use += size
+
+    async def release(self, size):
+        condition = self.get_condition()
+        async with condition:
+            self.in_use = max(self.in_use - size, 0)
+            condition.notify_all()
+
+
+byte_budget = ByteBudget(MAX_IN_FLIGHT_BYTES)
+
+
+# 按固定缓冲区把响应体写入已打开的文件，返回写入的字节数，limiter为限速令牌桶
+async def stream_to_file(response, file, buffer_size=BUFFER_SIZE, on_data=None, limiter=None):
+    written = 0
+    async for data in response.content.iter_chunked(buffer_size):
+        # 读取的数据在写入文件前计入在途字节
+        size = len(data)
+        await byte_budget.acquire(size)
+        try:
+            if limiter is not None:
+                await limiter.consume(size)
+            file.write(data)
+            written += size
+            if on_data is not None:
+                on_data(data)
+        finally:
+            await byte_budget.release(size)
+    return written
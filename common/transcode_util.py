@@ -0,0 +1,87 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# 设备屏幕分辨率 (宽, 高, 是否黑白屏)，未列出的设备不转码
+DEVICE_PROFILES = {
+    'kindle': (600, 800, True),
+    'kindle_dx': (824, 1200, True),
+    'kindle_fire': (600, 1024, False),
+    'kindle_oasis': (1264, 1680, True),
+    'kindle_pw': (758, 1024, True),
+    'kindle_pw3': (1072, 1448, True),
+    'kindle_scribe': (1860, 2480, True),
+    'kindle_voyage': (1072, 1448, True),
+    'ipad': (768, 1024, False),
+    'ipad3': (1536, 2048, False),
+    'kobo': (600, 800, True),
+    'nook': (600, 800, True),
+    'nook_color': (600, 1024, False),
+    'nook_hd_plus': (1280, 1920, False),
+    'pocketbook_inkpad3': (1404, 1872, True),
+    'pocketbook_lux': (758, 1024, True),
+    'pocketbook_hd': (1072, 1448, True),
+    'pocketbook_pro_912': (825, 1200, True),
+    'generic_eink': (600, 800, True),
+    'generic_eink_hd': (1072, 1448, True),
+    'generic_eink_large': (824, 1200, True),
+}
+# 黑白屏的灰度级数
+EINK_GRAY_LEVELS = 16
+# 灰度量化查找表，把0-255映射到最接近的灰度级
+GRAY_LUT = (np.round(np.arange(256) / 255 * (EINK_GRAY_LEVELS - 1)) * (255 // (EINK_GRAY_LEVELS - 1))).astype(np.uint8)
+
+
+# 根据设备名称获取转码参数，不需要转码时返回None
+def get_device_profile(device):
+    profile = DEVICE_PROFILES.get(device)
+    if profile is None:
+        return None
+    width, height, grayscale = profile
+    return {'width': width, 'height': height, 'grayscale': grayscale}
+
+
+# 缩放到设备分辨率以内，黑白屏转换为灰度并量化
+def transcode_image(img, profile):
+    img = ImageOps.exif_transpose(img)
+    if profile['grayscale']:
+        img = img.convert('L')
+    elif img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img.thumbnail((profile['width'], profile['height']), Image.LANCZOS, reducing_gap=3.0)
+    if profile['grayscale']:
+        img = Image.fromarray(GRAY_LUT[np.asarray(img)])
+    return img
+
+
+# 按扩展名保存，保持原文件格式
+def save_image(img, file, ext, quality):
+    ext = ext.lower()
+    if ext == '.png':
+        img.save(file, 'PNG', optimize=True)
+    elif ext == '.webp':
+        img.save(file, 'WEBP', quality=quality)
+    else:
+        img.save(file, 'JPEG', quality=quality, optimize=True)
+
+
+# 转码一批图片文件，原地替换，在子进程中执行，返回处理的数量
+def transcode_files(file_paths, profile, quality):
+    for file_path in file_paths:
+        with Image.open(file_path) as img:
+            img = transcode_image(img, profile)
+        temp_path = f'{file_path}.part'
+        save_image(img, temp_path, os.path.splitext(file_path)[1], quality)
+        os.replace(temp_path, file_path)
+    return len(file_paths)
+
+
+# 转码单张图片内容，在子进程中执行
+def transcode_data(data, ext, profile, quality):
+    with Image.open(io.BytesIO(data)) as img:
+        img = transcode_image(img, profile)
+    output = io.BytesIO()
+    save_image(img, output, ext, quality)
+    return output.getvalue()
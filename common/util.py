@@ -3,14 +3,14 @@ import json
 import logging
 import os
 import shutil
-import subprocess
 import traceback
 from datetime import datetime
 
 import requests
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad
-from PIL import Image
+
+from common.pdf_util import StreamingPdfWriter
 
 
 # 获取当前时间字符串
@@ -28,6 +28,22 @@ def truncate_string(s, length=10):
     return s
 
 
+# 格式化下载速度，如 1.2MB/s
+def format_speed(speed):
+    for unit in ('B', 'KB', 'MB'):
+        if speed < 1024:
+            return f'{speed:.0f}{unit}/s' if unit == 'B' else f'{speed:.1f}{unit}/s'
+        speed /= 1024
+    return f'{speed:.1f}GB/s'
+
+
+# 格式化剩余时间，如 01:05、1:02:03
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes:02d}:{seconds:02d}'
+
+
 def format_text(text, max_length=5, max_lines=2):
     """
     格式化字符串，使其最多显示 max_lines 行，每行最多包含 max_length 个字符。
@@ -165,43 +181,16 @@ def del_folder(directory):
 
 
 def img_to_pdf(image_files, folder_path, output_pdf_path):
-    # 创建一个空列表来存放图像对象
-    images = []
-    # 打开每张图片，并将其添加到列表中
-    for image_file in image_files:
-        image_path = os.path.join(folder_path, image_file)
-        logging.info(image_path)
-        img = Image.open(image_path)
-        # 将图像转换为 RGB 模式（PDF 需要 RGB 模式）
-        img = img.convert('RGB')
-        images.append(img)
-
-    # 保存为 PDF 文件
-    if images:
-        images[0].save(output_pdf_path, save_all=True, append_images=images[1:])
-        logging.info(f"成功将图片合并为 PDF: {output_pdf_path}")
-    else:
+    if not image_files:
         logging.info("没有找到 JPG 图片。")
-
-
-def convert_epub_to_mobi(calibrePath, calibreOutputDevice, title, epub_file, mobi_file):
-    try:
-        # 检查文件是否存在
-        if not os.path.isfile(epub_file):
-            logging.info(f"文件 {epub_file} 不存在！")
-            return
-
-        # 调用 calibre 的 ebook-convert 命令
-        subprocess.run([f'{calibrePath}', epub_file, mobi_file,
-                        '--output-profile', f'{calibreOutputDevice}',
-                        '--title', f'{title}'
-                        ], check=True)
-        logging.info(f"转换成功！MOBI 文件已保存为 {mobi_file}")
-    except subprocess.CalledProcessError as e:
-        logging.info(f"转换过程中发生错误: {e}")
-    except Exception as e:
-        logging.info(traceback.format_exc())
-        logging.info(f"发生异常: {e}")
+        return
+    # 逐页写入，同一时间只保留一张图片
+    with StreamingPdfWriter(output_pdf_path) as writer:
+        for image_file in image_files:
+            image_path = os.path.join(folder_path, image_file)
+            logging.info(image_path)
+            writer.add_image(image_path)
+    logging.info(f"成功将图片合并为 PDF: {output_pdf_path}")
 
 
 def check_url(url):
@@ -220,6 +209,34 @@ def check_url(url):
         return False
 
 
+# 预分配文件空间，文件系统不支持时返回False
+def preallocate_file(file_path, size):
+    try:
+        with open(file_path, 'wb') as f:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+        return True
+    except OSError:
+        logging.info(traceback.format_exc())
+        logging.info(f'预分配文件失败: {file_path}')
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+        return False
+
+
+# 根据已完成的区间计算缺失的区间，并按块大小切分
+def get_missing_ranges(completed_ranges, file_size, chunk_size):
+    missing = []
+    position = 0
+    for start, end in sorted(completed_ranges) + [(file_size, file_size)]:
+        if start > position:
+            missing.extend((i, min(i + chunk_size, start) - 1) for i in range(position, start, chunk_size))
+        position = max(position, end + 1)
+    return missing
+
+
 def delete_files_with_character(directory, character):
     # 遍历目录中的所有文件
     for root, dirs, files in os.walk(directory):
@@ -1,27 +1,45 @@
 import asyncio
 import datetime
+import hashlib
+import io
+import json
 import logging
 import os
-import queue
+import re
 import time
 import traceback
 
 import aiohttp
 import requests
-from PyQt5.QtCore import QThread, QMutex, pyqtSignal
+from PyQt5.QtCore import QThread, QMutex, QObject, pyqtSignal
 from bs4 import BeautifulSoup
-from ebooklib import epub
-from natsort import natsorted
 
+from common.calibre_util import calibre_pool, is_calibre_executable
+from common.cbz_util import CbzWriter
+from common.chunk_controller import ChunkController
+from common.comic_packager import package_chapter, post_process_stage, chapter_save_path, PAGE_EXTENSIONS
 from common.config import cfg
+from common.download_loop import download_loop
+from common.download_scheduler import download_scheduler, DownloadStopped, STATUS_CANCELLED
+from common.epub_util import StreamingEpubWriter
+from common.hash_util import guess_hash_algorithm, check_content_md5, OrderedHasher, read_file_range
+from common.http_client import get_session
+from common.image_cache import image_cache
+from common.job_queue import ChapterJob, ChapterJobQueue
+from common.page_util import clean_page_files, clean_page_data
+from common.progress_events import progress_events
+from common.progress_writer import progress_writer
+from common.rate_limiter import TokenBucket
+from common.retry_util import RetryPolicy, FatalDownloadError, RetryBudgetExhausted
 from common.sqlite_util import SQLiteDatabase
-from common.util import get_current_time, analyze_data, del_folder_images, del_folder, img_to_pdf, \
-    convert_epub_to_mobi, del_file, delete_files_with_character
-from view.download_interface import book_process_signals, download_signals, comic_process_signals
+from common.stream_util import stream_to_file
+from common.transcode_util import get_device_profile, transcode_files, transcode_data
+from common.util import get_current_time, analyze_data, del_file, delete_files_with_character, \
+    preallocate_file, get_missing_ranges
+from view.download_interface import download_signals
 
 comic_search_lock = QMutex()
 book_search_lock = QMutex()
-download_comic_lock = QMutex()
 
 URL = 'https://www.mangacopy.com/'
 WEBSITE = 'https://www.copymanga.com/'
@@ -37,6 +55,17 @@ API_HEADER = {
 }
 
 
+# 全局下载限速，图书和漫画分别共享一个令牌桶，修改设置后立即生效
+book_limiter = TokenBucket(cfg.get(cfg.bookSpeedLimit) * 1024)
+comic_limiter = TokenBucket(cfg.get(cfg.comicSpeedLimit) * 1024)
+cfg.bookSpeedLimit.valueChanged.connect(lambda value: book_limiter.set_rate(value * 1024))
+cfg.comicSpeedLimit.valueChanged.connect(lambda value: comic_limiter.set_rate(value * 1024))
+image_cache.set_limit(cfg.get(cfg.imageCacheSize) * 1024 * 1024)
+# 下载进度和状态合并后批量通知界面
+progress_events.set_listener(download_signals.success.emit)
+cfg.imageCacheSize.valueChanged.connect(lambda value: image_cache.set_limit(value * 1024 * 1024))
+
+
 # 搜索图书
 class BookSearch(QThread):
     success = pyqtSignal(object, object)
@@ -74,18 +103,20 @@ class BookSearch(QThread):
 
 
 # 下载图书
-# 全局图书当前下载数量
-book_active_downloads = 0
-# 下载队列
-book_waiting_queue = queue.Queue()
+# 小于此大小的文件使用单连接下载
+SINGLE_STREAM_SIZE = 2 * 1024 * 1024
+# 等待服务器准备文件的最大轮询次数
+SERVER_READY_ATTEMPTS = 20
 
 
-class BookDownload(QThread):
+class BookDownload(QObject):
     success = pyqtSignal(object)
 
-    def __init__(self, book):
+    # history_id 继续下载时沿用的下载记录
+    def __init__(self, book, history_id=None):
         super(BookDownload, self).__init__()
         self.book = book
+        self.history_id = history_id
         self.cover = book['cover']
         self.book_name = book['title']
         self.book_author = book['author']
@@ -93,160 +124,436 @@ class BookDownload(QThread):
         self.book_hash = book['hash']
         self.book_extension = book['extension']
         self.process = 0
+        # 已下载字节数
+        self.downloaded = 0
+        # 下载中的临时文件
+        self.temp_file = None
+        # 是否直接写入预分配文件
+        self.direct_write = False
+        # 重试策略，整本书共享重试次数上限
+        self.retry_policy = RetryPolicy(budget=100)
+        # 整个文件的增量hash
+        self.hasher = None
+
+    async def download_chunk(self, session, url, start, end, controller, history_id, file_size):
+        await self.retry_policy.call(self.fetch_chunk, session, url, start, end, controller, history_id,
+                                     file_size)
+
+    # 下载单个分块，失败由重试策略处理
+    async def fetch_chunk(self, session, url, start, end, controller, history_id, file_size):
+        # 边下载边计算分块hash和整个文件的hash
+        chunk_digest = hashlib.md5()
+        position = start
+
+        def on_data(data):
+            nonlocal position
+            chunk_digest.update(data)
+            self.hasher.update(position, data, start)
+            position += len(data)
 
-    async def download_chunk(self, session, url, start, end, chunk_id, sem, history_id, process):
-        async with sem:
-            for attempt in range(99):
-                sqlite_util = SQLiteDatabase()
-                try:
-                    headers = {'Range': f'bytes={start}-{end}'}
-                    async with session.get(url, headers=headers,
-                                           timeout=aiohttp.ClientTimeout(sock_read=30)) as response:
-                        response.raise_for_status()
-                        if response.status == 206:  # 206 Partial Content
-                            content = await response.read()
-                            file_path = os.path.join('app/chunks',
-                                                     f'{self.book_id}_{self.book_hash}_{chunk_id}.part')
-                            with open(file_path, 'wb') as f:
-                                f.write(content)
-                            # 更新进度
-                            self.process += process
-                            sqlite_util.update_data('cmbok_download_history',
-                                                    {'process': self.process},
-                                                    {'id': history_id})
-                            book_process_signals.success.emit(history_id, self.process)
-                            break
-                except Exception as e:
-                    sqlite_util.rollback()
-                    logging.info(f'Chunk {chunk_id} error: {start}-{end}')
-                    logging.info(traceback.format_exc())
-                    logging.info(f'下载过程中出现错误: {e}')
-                    if attempt < 99 - 1:
-                        logging.info(f"正在重试... (尝试次数: {attempt + 1})")
-                        time.sleep(1)  # 等待重试
+        try:
+            chunk_start_time = time.monotonic()
+            headers = {'Range': f'bytes={start}-{end}'}
+            async with session.get(url, headers=headers,
+                                   timeout=aiohttp.ClientTimeout(sock_read=30)) as response:
+                response.raise_for_status()
+                if response.status != 206:  # 206 Partial Content
+                    raise FatalDownloadError(f'服务器未返回分段内容: {response.status}')
+                if self.direct_write:
+                    # 边下载边写入预分配文件的对应位置
+                    with open(self.temp_file, 'r+b') as f:
+                        f.seek(start)
+                        written = await stream_to_file(response, f, on_data=on_data, limiter=book_limiter)
+                else:
+                    with open(self.get_part_file(start), 'wb') as f:
+                        written = await stream_to_file(response, f, on_data=on_data, limiter=book_limiter)
+                if written != end - start + 1:
+                    raise aiohttp.ClientPayloadError(f'分块数据不完整: {written}/{end - start + 1}')
+                # 服务器提供了Content-MD5时校验分块，不一致则只重新下载该分块
+                verified = check_content_md5(response.headers, chunk_digest.digest())
+                if verified is False:
+                    raise aiohttp.ClientPayloadError(f'分块校验失败: {start}-{end}')
+        except Exception:
+            controller.on_error()
+            # 失败分块还未计算的数据不再使用
+            self.hasher.discard(start)
+            logging.info(f'Chunk error: {start}-{end}')
+            logging.info(traceback.format_exc())
+            raise
+
+        # 记录已完成的区间，用于断点续传
+        progress_writer.insert('cmbok_download_chunk', {'key': self.book_id,
+                                                        'book_hash': self.book_hash,
+                                                        'file_size': file_size,
+                                                        'start': start,
+                                                        'end': end,
+                                                        'chunk_hash': chunk_digest.hexdigest(),
+                                                        'verified': 1 if verified else 0,
+                                                        'history_id': history_id})
+        # 更新进度
+        self.downloaded += end - start + 1
+        self.process = int(self.downloaded * 100 / file_size)
+        progress_writer.update(history_id, {'process': self.process})
+        self.hasher.complete(start, end)
+        progress_events.report(history_id, 2, self.process, self.downloaded, file_size)
+        controller.on_success(end - start + 1, time.monotonic() - chunk_start_time)
+
+    # 释放整个文件hash的计算线程和缓存的数据
+    def close_hasher(self):
+        if self.hasher is not None:
+            self.hasher.close()
+
+    # 下载流程：等待服务器准备文件，探测是否支持分段，选择分段或单连接下载
+    async def transfer(self, history_id):
+        try:
+            await self.transfer_file(history_id)
+        finally:
+            self.close_hasher()
+
+    async def transfer_file(self, history_id):
+        session = get_session()
+        await self.wait_server_ready(session)
+        file_size = await self.get_file_size(session)
+        url = f'{CMBOK_WEBSITE}cmbok/zlibrary/download_file/{self.book_id}/{self.book_hash}/{self.book_extension}'
+        # 小文件或服务器不支持分段时使用单连接下载
+        if file_size is None or file_size <= SINGLE_STREAM_SIZE or not await self.support_range(session, url):
+            progress_writer.update(history_id, {'transfer_info': json.dumps({'mode': 'single',
+                                                                             'file_size': file_size})})
+            await self.retry_policy.call(self.download_single, session, url, history_id, file_size)
+        else:
+            await self.download_file(url, history_id, file_size)
+
+    # 轮询服务器，直到文件准备完成
+    async def wait_server_ready(self, session):
+        url = f'{CMBOK_WEBSITE}cmbok/zlibrary/download/{self.book_id}/{self.book_hash}/{self.book_extension}'
+        for attempt in range(SERVER_READY_ATTEMPTS):
+            results = await self.retry_policy.call(self.fetch_json, session, url)
+            if results is not None and results.get('download_status'):
+                return
+            delay = self.retry_policy.backoff(attempt + 1)
+            logging.info(f'{self.book_name}服务器还未准备好文件，{delay:.1f}秒后重试')
+            await asyncio.sleep(delay)
+        raise FatalDownloadError(f'{self.book_name}服务器未能准备好文件')
+
+    async def fetch_json(self, session, url):
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=60)) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    # 获取文件大小，服务器没有返回时为None
+    async def get_file_size(self, session):
+        file_name = f'{self.book_id}_{self.book_hash}.{self.book_extension}'
+        async with session.head(f'{CMBOK_WEBSITE}static/files/{file_name}', allow_redirects=True,
+                                timeout=aiohttp.ClientTimeout(total=30)) as response:
+            response.raise_for_status()
+            content_length = response.headers.get('Content-Length')
+            return int(content_length) if content_length else None
+
+    # 请求第一个字节，返回206说明服务器支持分段下载
+    async def support_range(self, session, url):
+        try:
+            async with session.get(url, headers={'Range': 'bytes=0-0'},
+                                   timeout=aiohttp.ClientTimeout(total=30)) as response:
+                response.raise_for_status()
+                return response.status == 206
+        except Exception:
+            logging.info(traceback.format_exc())
+            logging.info(f'{self.book_name}探测分段下载失败，使用单连接下载')
+            return False
+
+    # 单连接下载整个文件，失败时从头开始
+    async def download_single(self, session, url, history_id, file_size):
+        output_file = self.get_output_file()
+        self.temp_file = f'{output_file}.part'
+        algorithm = guess_hash_algorithm(self.book_hash)
+        self.close_hasher()
+        self.hasher = OrderedHasher(algorithm or 'md5', None)
+        self.downloaded = 0
+
+        def on_data(data):
+            if download_scheduler.is_stopped(history_id):
+                raise DownloadStopped(self.book_name)
+            self.hasher.update(self.downloaded, data)
+            self.downloaded += len(data)
+            if file_size:
+                process = int(self.downloaded * 100 / file_size)
+                progress_events.report(history_id, 2, process, self.downloaded, file_size)
+                if process != self.process:
+                    self.process = process
+                    progress_writer.update(history_id, {'process': process})
+
+        async with session.get(url, timeout=aiohttp.ClientTimeout(sock_read=30)) as response:
+            response.raise_for_status()
+            with open(self.temp_file, 'wb') as f:
+                written = await stream_to_file(response, f, on_data=on_data, limiter=book_limiter)
+        if file_size is not None and written != file_size:
+            raise aiohttp.ClientPayloadError(f'文件数据不完整: {written}/{file_size}')
+        if await self.verify_file_hash(algorithm) is False:
+            del_file(self.temp_file)
+            raise FatalDownloadError(f'{self.book_name}校验失败')
+        # 原子重命名为最终文件
+        os.replace(self.temp_file, output_file)
+        logging.info(f'download {output_file} finish!!!')
+        await self.download_success(history_id)
+
+    # 校验整个文件的hash，book_hash不是文件摘要时返回None，等待hash计算线程时不阻塞事件循环
+    async def verify_file_hash(self, algorithm):
+        file_hash = await asyncio.get_running_loop().run_in_executor(None, self.hasher.hexdigest)
+        if algorithm is None:
+            logging.info(f'{self.book_name}无法校验，文件{self.hasher.hash.name}: {file_hash}')
+            return None
+        if file_hash == self.book_hash.lower():
+            logging.info(f'{self.book_name}校验通过')
+            return True
+        logging.info(f'{self.book_name}校验失败: {file_hash}，期望: {self.book_hash}')
+        return False
+
+    async def download_file(self, url, history_id, file_size):
+        output_file = self.get_output_file()
+        self.temp_file = f'{output_file}.part'
+        # book_hash是文件摘要时校验下载结果，否则只记录md5
+        algorithm = guess_hash_algorithm(self.book_hash)
+        for verify_round in range(2):
+            completed_ranges = await self.download_missing_ranges(url, history_id, file_size, algorithm or 'md5')
+            if await self.verify_file_hash(algorithm) is not False:
+                break
+            if verify_round > 0:
+                # 重新下载后仍不一致，清除记录避免下次继续使用错误数据
+                await self.clear_completed_ranges()
+                del_file(self.temp_file)
+                raise FatalDownloadError(f'{self.book_name}校验失败')
+            # 只重新下载有问题的区间，在线程池中读取磁盘，不阻塞其他下载
+            await progress_writer.flush_async()
+            chunk_ids = await asyncio.get_running_loop().run_in_executor(None, self.find_corrupted_chunks)
+            for chunk_id in chunk_ids:
+                progress_writer.execute('DELETE FROM cmbok_download_chunk WHERE id = ?;', (chunk_id,))
+            await progress_writer.flush_async()
+
+        if not self.direct_write:
+            # 在线程池中合并文件，不阻塞其他下载
+            await asyncio.get_running_loop().run_in_executor(None, self.merge_files, completed_ranges,
+                                                             self.temp_file)
+        # 原子重命名为最终文件
+        os.replace(self.temp_file, output_file)
+        logging.info(f'download {output_file} finish!!!')
+        await self.clear_completed_ranges()
+        await self.download_success(history_id)
+
+    # 按记录的分块md5检查磁盘上没有经过服务器校验的分块，返回写入出错的分块id；
+    # 全部一致时说明数据在传输中出错，无法定位到分块，返回所有未经服务器校验的分块id
+    def find_corrupted_chunks(self):
+        with SQLiteDatabase() as db:
+            chunks = [chunk for chunk in db.query_data('cmbok_download_chunk',
+                                                       {'key': self.book_id, 'book_hash': self.book_hash})
+                      if not chunk.verified]
+        corrupted = []
+        for chunk in chunks:
+            digest = hashlib.md5()
+            try:
+                if self.direct_write:
+                    data = read_file_range(self.temp_file, chunk.start, chunk.end)
+                else:
+                    data = read_file_range(self.get_part_file(chunk.start), chunk.start, chunk.end,
+                                           offset=chunk.start)
+                for block in data:
+                    digest.update(block)
+            except OSError:
+                logging.info(traceback.format_exc())
+                corrupted.append(chunk.id)
+                continue
+            if digest.hexdigest() != chunk.chunk_hash:
+                corrupted.append(chunk.id)
+        if corrupted:
+            logging.info(f'{self.book_name}有{len(corrupted)}个分块写入出错，重新下载这些分块')
+            return corrupted
+        logging.info(f'{self.book_name}分块数据和下载时一致，重新下载所有未经服务器校验的分块')
+        return [chunk.id for chunk in chunks]
+
+    # 下载缺失的区间，返回文件所有区间
+    async def download_missing_ranges(self, url, history_id, file_size, algorithm):
+        # 读取上次未完成的区间，只下载缺失部分
+        completed_ranges = await self.load_completed_ranges(file_size)
+        self.downloaded = sum(end - start + 1 for start, end in completed_ranges)
+        self.process = int(self.downloaded * 100 / file_size)
+        # 缺失的连续区间，下载时按当前分块大小切分
+        gaps = get_missing_ranges(completed_ranges, file_size, file_size)
+        if completed_ranges:
+            logging.info(f'{self.book_name}断点续传，已完成{self.downloaded}/{file_size}字节')
+        # 整个文件的hash，已完成的区间从磁盘读取
+        self.close_hasher()
+        if self.direct_write:
+            self.hasher = OrderedHasher(algorithm, lambda chunk_start, start, end: read_file_range(
+                self.temp_file, start, end))
+        else:
+            self.hasher = OrderedHasher(algorithm, lambda chunk_start, start, end: read_file_range(
+                self.get_part_file(chunk_start), start, end, offset=chunk_start))
+        for start, end in completed_ranges:
+            self.hasher.complete(start, end)
+        # 根据吞吐量自适应调整分块大小和并发数
+        controller = ChunkController(file_size)
+        missing_ranges = []
+        # 共享的连接池客户端
+        session = get_session()
+        pending = set()
+        try:
+            while gaps or pending:
+                if download_scheduler.is_stopped(history_id):
+                    # 暂停或取消，保留已完成的区间，继续下载时断点续传
+                    raise DownloadStopped(self.book_name)
+                while gaps and len(pending) < controller.concurrency:
+                    start, end = gaps[0]
+                    chunk_end = min(start + controller.next_chunk_size() - 1, end)
+                    if chunk_end == end:
+                        gaps.pop(0)
                     else:
-                        logging.info("达到最大重试次数，下载失败。")
-                        raise e
-                finally:
-                    sqlite_util.close()
-
-    async def download_file(self, url, total_parts, history_id, max_concurrent_chunks=5):
-        sem = asyncio.Semaphore(max_concurrent_chunks)
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            process = int(100 / len(total_parts))
-            for start, end, index in total_parts:
-                tasks.append(self.download_chunk(session, url, start, end, index, sem, history_id, process))
-            await asyncio.gather(*tasks)
-
-            # 合并文件
-            output_file = os.path.join(cfg.get(cfg.downloadFolder),
-                                       f'{self.book_name}_{self.book_id}.{self.book_extension}')
-            self.merge_files(total_parts, output_file)
-            self.download_success(history_id)
+                        gaps[0] = (chunk_end + 1, end)
+                    missing_ranges.append((start, chunk_end))
+                    pending.add(asyncio.create_task(
+                        self.download_chunk(session, url, start, chunk_end, controller, history_id, file_size)))
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+        except BaseException:
+            # 取消其他分块并等待结束，停止或失败后不再有分块写入文件
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            self.close_hasher()
+            raise
+        finally:
+            # 记录本次选择的下载参数
+            progress_writer.update(history_id, {'transfer_info': json.dumps(dict(controller.report(), mode='range'))})
+        return sorted(completed_ranges + missing_ranges)
+
+    # 读取已完成的区间，文件大小变化或临时文件丢失时重新开始
+    async def load_completed_ranges(self, file_size):
+        chunks = await asyncio.get_running_loop().run_in_executor(None, self.query_chunks)
+        completed_ranges = [(chunk.start, chunk.end) for chunk in chunks]
+        if completed_ranges and all(chunk.file_size == file_size for chunk in chunks):
+            if os.path.isfile(self.temp_file) and os.path.getsize(self.temp_file) == file_size:
+                # 继续写入预分配文件
+                self.direct_write = True
+                return completed_ranges
+            if all(os.path.isfile(self.get_part_file(start)) for start, end in completed_ranges):
+                # 继续使用分块文件
+                self.direct_write = False
+                return completed_ranges
+
+        await self.clear_completed_ranges()
+        # 预分配目标文件，各块直接写入对应偏移；不支持预分配时退回分块文件再合并
+        self.direct_write = preallocate_file(self.temp_file, file_size)
+        return []
+
+    # 清除断点续传记录
+    async def clear_completed_ranges(self):
+        # 通过写入线程删除，排在还在队列中的区间记录之后
+        progress_writer.execute('DELETE FROM cmbok_download_chunk WHERE key = ? AND book_hash = ?;',
+                                (self.book_id, self.book_hash))
+        await progress_writer.flush_async()
+        await asyncio.get_running_loop().run_in_executor(None, delete_files_with_character, 'app/chunks',
+                                                         f'{self.book_id}_{self.book_hash}_')
+
+    # 读取断点续传的区间记录，在线程池中执行
+    def query_chunks(self):
+        with SQLiteDatabase() as db:
+            return db.query_data('cmbok_download_chunk', {'key': self.book_id, 'book_hash': self.book_hash})
+
+    # 图书保存路径
+    def get_output_file(self):
+        return os.path.join(cfg.get(cfg.downloadFolder), f'{self.book_name}_{self.book_id}.{self.book_extension}')
+
+    # 分块文件路径
+    def get_part_file(self, start):
+        return os.path.join('app/chunks', f'{self.book_id}_{self.book_hash}_{start}.part')
 
     def merge_files(self, total_parts, output_file):
         with open(output_file, 'wb') as merged_file:
-            for start, end, index in total_parts:
-                part_filename = os.path.join('app/chunks',
-                                             f'{self.book_id}_{self.book_hash}_{index}.part')
-                with open(part_filename, 'rb') as part_file:
+            for start, end in total_parts:
+                with open(self.get_part_file(start), 'rb') as part_file:
                     merged_file.write(part_file.read())
             logging.info(f'merged {output_file} finish!!!')
 
-        for start, end, index in total_parts:
-            part_filename = os.path.join('app/chunks',
-                                         f'{self.book_id}_{self.book_hash}_{index}.part')
-            os.remove(part_filename)
-
-    def download_success(self, history_id):
-        global book_active_downloads
+    async def download_success(self, history_id):
+        # 先写入还在队列中的进度，避免覆盖最终状态
+        await progress_writer.flush_async()
         with SQLiteDatabase() as db:
             # 下载完成
-            book_active_downloads -= 1
             db.update_data('cmbok_download_history',
                            {'status': 3, 'process': 100, 'finish_time': get_current_time()},
                            {'id': history_id})
-            download_signals.success.emit('success', self.book_name, self.book_author, 2)
+            progress_events.notify('success', self.book_name, self.book_author, 2)
 
-    def download_fail(self, history_id):
-        global book_active_downloads
+    async def download_fail(self, history_id):
+        # 先写入还在队列中的进度，避免覆盖最终状态
+        await progress_writer.flush_async()
         with SQLiteDatabase() as db:
             # 下载失败
-            book_active_downloads -= 1
             db.update_data('cmbok_download_history',
                            {'status': 0, 'finish_time': get_current_time()},
                            {'id': history_id})
-            download_signals.success.emit('error', self.book_name, self.book_author, 2)
+            progress_events.notify('error', self.book_name, self.book_author, 2)
 
-    def run(self):
-        global book_active_downloads
+    # 等待调度器分配下载名额后开始下载，结束后释放名额
+    async def scheduled_transfer(self, history_id):
+        if not await download_scheduler.acquire(history_id):
+            # 等待时被暂停或取消
+            return
+        try:
+            with SQLiteDatabase() as db:
+                db.update_data('cmbok_download_history', {'status': 1, 'start_time': get_current_time()},
+                               {'id': history_id})
+            os.makedirs('app/chunks', exist_ok=True)
+            os.makedirs(cfg.get(cfg.downloadFolder), exist_ok=True)
+            await self.transfer(history_id)
+        except DownloadStopped:
+            # 暂停时保留已下载的区间和临时文件，继续下载时断点续传，取消时删除
+            status = download_scheduler.stopped_status(history_id)
+            if status == STATUS_CANCELLED:
+                await asyncio.get_running_loop().run_in_executor(None, clear_book_files, history_id, self.book_id,
+                                                                 self.book_hash, f'{self.get_output_file()}.part')
+            # 状态排在还在队列中的进度之后写入
+            progress_writer.update(history_id, {'status': status})
+            await progress_writer.flush_async()
+            logging.info(f'{self.book_name}已停止下载')
+        finally:
+            download_scheduler.release(history_id)
+
+    # 提交到共享的下载事件循环
+    def start(self):
+        download_loop.submit(self.run())
+
+    async def run(self):
         sqlite_util = SQLiteDatabase()
-        history_id = 0
+        history_id = self.history_id
 
         try:
             self.success.emit('success')
-            # 先保存保存下载记录
-            history_id = sqlite_util.insert_data('cmbok_download_history', {'cover': '',
-                                                                            'name': self.book_name,
-                                                                            'author': self.book_author,
-                                                                            'key': self.book_id,
-                                                                            'book_hash': self.book_hash,
-                                                                            'process': 0,
-                                                                            'type': 2,
-                                                                            'status': 2})
-            # 队列是否已满
-            if book_active_downloads < cfg.get(cfg.downloadThreadNum):
-                # 开始下载
-                book_active_downloads += 1
-                sqlite_util.update_data('cmbok_download_history',
-                                        {'status': 1, 'start_time': get_current_time()},
-                                        {'id': history_id})
-
-                url = f'{CMBOK_WEBSITE}cmbok/zlibrary/download/{self.book_id}/{self.book_hash}/{self.book_extension}'
-                response = requests.get(url)
-                response.raise_for_status()
-                if response.status_code == 200:
-                    results = response.json()
-                    download_status = results['download_status']
-                    if download_status:
-                        file_name = f'{self.book_id}_{self.book_hash}.{self.book_extension}'
-                        # 先获取文件大小
-                        head = requests.head(f'{CMBOK_WEBSITE}static/files/{file_name}')
-
-                        if head.status_code == 200:
-                            file_size = int(head.headers.get('Content-Length'))
-                            chunk_size = 1024 * 512  # 每个块0.5MB
-                            # 计算块的数量
-                            chunks = [(i, min(i + chunk_size - 1, file_size - 1), index)
-                                      for index, i in enumerate(range(0, file_size, chunk_size))]
-                            # 下载每个块
-                            url = f'{CMBOK_WEBSITE}cmbok/zlibrary/download_file/{self.book_id}/{self.book_hash}/{self.book_extension}'
-
-                            os.makedirs('app/chunks', exist_ok=True)
-
-                            asyncio.run(self.download_file(url, chunks, history_id, max_concurrent_chunks=10))
-                        else:
-                            self.download_fail(history_id)
-                    else:
-                        self.download_fail(history_id)
-
-                    # 继续下一个等待的下载任务（如果有的话）
-                    if not book_waiting_queue.empty():
-                        next_book = book_waiting_queue.get()
-                        bookDownload = BookDownload(book=next_book)
-                        bookDownload.start()
+            if history_id is None:
+                # 先保存保存下载记录
+                history_id = sqlite_util.insert_data('cmbok_download_history', {
+                    'cover': '',
+                    'name': self.book_name,
+                    'author': self.book_author,
+                    'key': self.book_id,
+                    'book_hash': self.book_hash,
+                    'process': 0,
+                    'type': 2,
+                    'status': 2,
+                    'priority': 0,
+                    'payload': json.dumps({'cover': self.cover, 'extension': self.book_extension})})
+                download_scheduler.enqueue(history_id, 0)
             else:
-                book_waiting_queue.put(self.book)
+                priority = sqlite_util.query_first_data('cmbok_download_history', {'id': history_id}).priority or 0
+                # 加入下载队列，已在队列或下载中时不重复下载，也不修改其状态
+                if not download_scheduler.enqueue(history_id, priority):
+                    return
+                sqlite_util.update_data('cmbok_download_history', {'status': 2}, {'id': history_id})
+            await self.scheduled_transfer(history_id)
         except Exception:
             sqlite_util.rollback()
-            delete_files_with_character('app/chunks', f'{self.book_id}_{self.book_hash}')
-            self.download_fail(history_id)
-            # 继续下一个等待的下载任务（如果有的话）
-            if not book_waiting_queue.empty():
-                next_book = book_waiting_queue.get()
-                bookDownload = BookDownload(book=next_book)
-                bookDownload.start()
+            # 保留已下载的区间和临时文件，重新下载时断点续传
+            await self.download_fail(history_id)
             logging.info(traceback.format_exc())
             logging.info('下载图书失败')
         finally:
@@ -348,10 +655,7 @@ class ComicCollects(QThread):
 
 
 # 获取漫画目录下所有图片
-download_locked = False
-
-
-class ComicChapterImages(QThread):
+class ComicChapterImages(QObject):
     success = pyqtSignal(object)
 
     def __init__(self, comic_name, comic_path_word, comic_author, checked_chapters):
@@ -361,76 +665,323 @@ class ComicChapterImages(QThread):
         self.checked_chapters = checked_chapters
         self.comic_author = comic_author
 
-    def run(self):
-        global download_locked
-        if download_locked:
-            self.success.emit('lock')
-        else:
-            download_comic_lock.lock()
-            download_locked = True
-            try:
-                self.success.emit('success')
-                comicDownload = ComicDownload()
-                asyncio.run(
-                    comicDownload.start_download_chapter(self.checked_chapters, self.comic_path_word, self.comic_name,
-                                                         self.comic_author))
-            except Exception as e:
-                self.success.emit('error')
-                logging.info(traceback.format_exc())
-                logging.info('获取漫画目录下所有图片失败')
+    # 提交到共享的下载事件循环
+    def start(self):
+        download_loop.submit(self.run())
+
+    async def run(self):
+        try:
+            self.success.emit('success')
+            await comic_download.start_download_chapter(self.checked_chapters, self.comic_path_word,
+                                                        self.comic_name, self.comic_author)
+        except Exception as e:
+            self.success.emit('error')
+            logging.info(traceback.format_exc())
+            logging.info('获取漫画目录下所有图片失败')
+
+
+# 为下载记录重新创建下载任务，调度器继续下载时调用
+def start_history_download(history):
+    if history.type == 1:
+        download = ComicChapterImages(history.name, history.key, history.author,
+                                      [{'name': history.chapter_name, 'id': history.chapter_path_word}])
+    else:
+        payload = json.loads(history.payload or '{}')
+        if 'extension' not in payload:
+            # 旧版本的下载记录没有保存扩展名
+            logging.info(f'{history.name}缺少下载参数，无法继续下载')
+            with SQLiteDatabase() as db:
+                db.update_data('cmbok_download_history', {'status': -2}, {'id': history.id})
+            return
+        download = BookDownload({'cover': payload.get('cover', ''), 'title': history.name, 'author': history.author,
+                                 'id': history.key, 'hash': history.book_hash, 'extension': payload['extension']},
+                                history_id=history.id)
+    download.start()
+
+
+# 删除图书的断点续传记录、分块文件和下载中的临时文件，同一本书还有其他未完成的下载记录时不删除
+def clear_book_files(history_id, book_id, book_hash, temp_file):
+    with SQLiteDatabase() as db:
+        historys = db.query_data('cmbok_download_history', {'key': book_id, 'book_hash': book_hash, 'type': 2})
+    if any(history.id != history_id and history.status in (1, 2, 4) for history in historys):
+        return
+    # 通过写入线程删除，排在还在队列中的分块记录之后
+    progress_writer.execute('DELETE FROM cmbok_download_chunk WHERE key = ? AND book_hash = ?;', (book_id, book_hash))
+    delete_files_with_character('app/chunks', f'{book_id}_{book_hash}_')
+    if os.path.isfile(temp_file):
+        del_file(temp_file)
+
+
+# 删除章节的页面清单和已下载的图片、临时文件
+def clear_chapter_files(history_id, path):
+    progress_writer.execute('DELETE FROM cmbok_download_page WHERE history_id = ?;', (history_id,))
+    if os.path.isdir(path):
+        delete_files_with_character(path, 'Cmbok_')
+        try:
+            os.rmdir(path)
+        except OSError:
+            # 目录中还有其他文件
+            pass
+
+
+# 删除下载记录的断点续传数据，已完成的下载只删除页面清单，保留生成的文件
+def clear_download_files(history):
+    unfinished = history.status not in (3, -4, -1)
+    if history.type == 2:
+        payload = json.loads(history.payload or '{}')
+        if unfinished and 'extension' in payload:
+            output_file = os.path.join(cfg.get(cfg.downloadFolder),
+                                       f'{history.name}_{history.key}.{payload["extension"]}')
+            clear_book_files(history.id, history.key, history.book_hash, f'{output_file}.part')
+    elif unfinished:
+        clear_chapter_files(history.id, f"{cfg.get(cfg.downloadFolder)}/{history.name}/{history.chapter_name}")
+    else:
+        progress_writer.execute('DELETE FROM cmbok_download_page WHERE history_id = ?;', (history.id,))
+
+
+download_scheduler.set_launcher(start_history_download)
+download_scheduler.set_cleaner(clear_download_files)
+
+
+# 同时解析章节页面的数量
+CHAPTER_RESOLVE_CONCURRENCY = 8
+# 所有章节共享的图片下载协程数量
+IMAGE_WORKER_NUM = 16
+# 章节图片下载失败后的重试轮数
+CHAPTER_RETRY_ROUNDS = 3
+# 每个页面处理任务（裁剪、转码）的图片数量
+PAGE_BATCH_SIZE = 8
+
 
-            finally:
-                download_comic_lock.unlock()
-            download_locked = False
+# 图片文件对应的页面序号，文件名为 Cmbok_序号 或拆分后的 Cmbok_序号_1
+def page_index(file_name):
+    match = re.match(r'Cmbok_(\d+)', file_name)
+    return int(match.group(1)) if match else None
 
 
-class ComicDownload(QThread):
-    success = pyqtSignal()
+# 从章节页面中解析并解密图片列表
+def parse_chapter_images(html):
+    data = analyze_data(
+        BeautifulSoup(html, 'html.parser').find(name="div", attrs={"class": "imageData"}).attrs['contentkey'])
+    return [i['url'] for i in data]
+
+
+class ComicDownload:
+    """ 漫画章节下载，所有漫画共享一个图片任务队列、固定数量的下载协程和章节解析并发数，在下载事件循环中首次使用时创建 """
 
     def __init__(self):
-        super(ComicDownload, self).__init__()
         self.process = 0
+        self.loop = None
+        self.job_queue = None
+        self.workers = []
+        self.resolve_sem = None
+
+    # 共享的图片任务队列，下载事件循环重新启动后重新创建
+    def get_job_queue(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.job_queue = ChapterJobQueue()
+            # 固定数量的图片下载协程，从所有漫画所有章节共享的队列中取任务
+            self.workers = [asyncio.create_task(self.image_worker(self.job_queue)) for _ in range(IMAGE_WORKER_NUM)]
+            self.resolve_sem = asyncio.Semaphore(CHAPTER_RESOLVE_CONCURRENCY)
+        return self.job_queue
 
     # 下载单个图片的异步函数
-    async def async_download_image(self, url, save_path, filename, history_id, shared_data, process):
-        sqlite_util = SQLiteDatabase()
+    async def async_download_image(self, url, job, index):
         # 保存图片，文件名可根据需要修改
+        ext = os.path.splitext(url)[1]
+        filename = ('Cmbok_' + str(index) + ext).replace('/', '')
+        loop = asyncio.get_running_loop()
         try:
-            filename = filename.replace('/', '')
-            if not os.path.exists(os.path.join(save_path, filename)):
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(sock_read=20)) as session:
-                    async with session.get(url) as response:
-                        response.raise_for_status()  # 抛出HTTP错误
-                        if response.status == 200:
-                            image_data = await response.read()
-                            with open(os.path.join(save_path, filename), 'wb') as f:
-                                f.write(image_data)
-                            # 更新进度
-                            shared_data['process'] += process
-                            sqlite_util.update_data('cmbok_download_history',
-                                                    {'process': shared_data['process']},
-                                                    {'id': history_id})
-                            comic_process_signals.success.emit(history_id, shared_data['process'])
-                        else:
-                            logging.info(f"Failed to download {url}")
+            if job.writers:
+                # 直接写入epub/cbz，不保存图片文件，优先使用缓存
+                data = await loop.run_in_executor(None, image_cache.read, url)
+                if data is None:
+                    data = await job.retry_policy.call(self.fetch_image_data, url, job, index)
+                    await loop.run_in_executor(None, image_cache.store_data, url, data)
+                size = len(data)
+                pages = [data]
+                if job.cleanup is not None:
+                    # 在进程池中裁剪白边、拆分跨页
+                    pages = await post_process_stage.call(clean_page_data, data, ext, job.cleanup)
+                for part, page in enumerate(pages, 1 if len(pages) > 1 else 0):
+                    if job.transcode is not None:
+                        # 在进程池中转码后再写入
+                        page = await post_process_stage.call(transcode_data, page, ext, *job.transcode)
+                    for writer in job.writers:
+                        writer.add_image(index, page, ext, part)
+            else:
+                file_path = os.path.join(job.path, filename)
+                # 缓存命中时直接链接到章节目录
+                if not os.path.exists(file_path) and not await loop.run_in_executor(None, image_cache.link, url,
+                                                                                    file_path):
+                    await job.retry_policy.call(self.fetch_image, url, file_path, job, index)
+                    await loop.run_in_executor(None, image_cache.store, url, file_path)
+                size = os.path.getsize(file_path)
+            job.finish_page(index, size)
+            # 更新页面清单
+            progress_writer.execute('UPDATE cmbok_download_page SET state = 1, size = ?, processed = 0 '
+                                    'WHERE history_id = ? AND page_index = ?;', (size, job.history_id, index))
+            self.report_progress(job)
+            return
         except asyncio.TimeoutError:
             logging.info(traceback.format_exc())
             logging.info("请求超时")
+            job.failed.append((index, url))
         except Exception as e:
             logging.info(traceback.format_exc())
             logging.info(f'图片url：{url}，图片名称：{filename}')
             logging.info('下载图片异常')
-        finally:
-            sqlite_util.close()
+            # 可重试的错误留到章节结束时再重试
+            if isinstance(e, RetryBudgetExhausted) or job.retry_policy.classify(e)[0]:
+                job.failed.append((index, url))
+            else:
+                job.lost += 1
+        job.fail_page(index)
+        progress_writer.execute('UPDATE cmbok_download_page SET state = -1 WHERE history_id = ? AND page_index = ?;',
+                                (job.history_id, index))
+
+    # 按接收的字节数更新进度，界面通知由progress_events合并，进度变化时才写入数据库
+    def report_progress(self, job):
+        process = job.percent()
+        progress_events.report(job.history_id, 1, process, job.received(), job.estimated_size())
+        if process != job.process:
+            job.process = process
+            progress_writer.update(job.history_id, {'process': process})
+
+    # 边接收边统计章节已下载的字节数
+    async def receive_image(self, response, file, job, index):
+        job.start_page(index, response.content_length)
+
+        def on_data(data):
+            job.add_bytes(index, len(data))
+            self.report_progress(job)
+
+        await stream_to_file(response, file, on_data=on_data, limiter=comic_limiter)
+
+    # 请求单个图片并边下载边写入文件，失败由重试策略处理
+    async def fetch_image(self, url, file_path, job, index):
+        temp_path = f'{file_path}.part'
+        try:
+            async with get_session().get(url, timeout=aiohttp.ClientTimeout(sock_read=20)) as response:
+                response.raise_for_status()  # 抛出HTTP错误
+                with open(temp_path, 'wb') as f:
+                    await self.receive_image(response, f, job, index)
+        except BaseException:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
+        # 写完再重命名，避免残缺图片被当作已下载
+        os.replace(temp_path, file_path)
+
+    # 请求单个图片，返回图片内容
+    async def fetch_image_data(self, url, job, index):
+        async with get_session().get(url, timeout=aiohttp.ClientTimeout(sock_read=20)) as response:
+            response.raise_for_status()  # 抛出HTTP错误
+            buffer = io.BytesIO()
+            await self.receive_image(response, buffer, job, index)
+            return buffer.getvalue()
+
+    # 读取页面清单中已完成的页面 序号 -> 大小，图片文件已不存在的页面需要重新下载
+    # 返回 (已完成的页面, 已裁剪、转码的页面序号)
+    def load_finished_pages(self, sqlite_util, history_id, path, image_urls):
+        finished_pages = {}
+        processed = set()
+        for page in sqlite_util.query_data('cmbok_download_page', {'history_id': history_id, 'state': 1}):
+            if page.page_index >= len(image_urls):
+                continue
+            name, ext = os.path.splitext(('Cmbok_' + str(page.page_index)
+                                          + os.path.splitext(image_urls[page.page_index])[1]).replace('/', ''))
+            # 跨页拆分后保存为 _1、_2
+            if not os.path.exists(os.path.join(path, name + ext)) and not os.path.exists(
+                    os.path.join(path, f'{name}_1{ext}')):
+                continue
+            finished_pages[page.page_index] = page.size or 0
+            if page.processed:
+                processed.add(page.page_index)
+        return finished_pages, processed
+
+    # 重新写入未完成页面的清单
+    def write_page_manifest(self, job, image_urls):
+        progress_writer.execute('DELETE FROM cmbok_download_page WHERE history_id = ? AND state != 1;',
+                                (job.history_id,))
+        for index, url in job.pending:
+            progress_writer.execute('DELETE FROM cmbok_download_page WHERE history_id = ? AND page_index = ?;',
+                                    (job.history_id, index))
+            progress_writer.insert('cmbok_download_page', {'history_id': job.history_id, 'page_index': index,
+                                                           'url': url, 'size': 0, 'state': 0})
+
+    # 转码参数 (设备参数, 图片质量)，未开启转码或设备没有分辨率参数时返回None
+    def get_transcode_options(self):
+        if not cfg.get(cfg.isTranscodeImages):
+            return None
+        profile = get_device_profile(cfg.get(cfg.calibreOutputDevice))
+        if profile is None:
+            return None
+        return profile, cfg.get(cfg.transcodeQuality)
+
+    # 页面整理参数，未开启裁剪和拆分时返回None
+    def get_cleanup_options(self):
+        if not cfg.get(cfg.isCropMargins) and not cfg.get(cfg.isSplitSpreads):
+            return None
+        return {'crop': cfg.get(cfg.isCropMargins),
+                'split': cfg.get(cfg.isSplitSpreads),
+                'right_first': cfg.get(cfg.splitRightFirst)}
+
+    # 在进程池中分批处理章节图片，跳过上次已处理的页面，返回每批的结果
+    async def process_chapter_images(self, job, func, *args):
+        files = [os.path.join(job.path, f) for f in os.listdir(job.path)
+                 if os.path.splitext(f)[1].lower() in PAGE_EXTENSIONS and page_index(f) not in job.processed]
+        batches = [files[i:i + PAGE_BATCH_SIZE] for i in range(0, len(files), PAGE_BATCH_SIZE)]
+        return await asyncio.gather(*[post_process_stage.call(func, batch, *args) for batch in batches])
+
+    # 是否需要生成epub，转换mobi且没有生成cbz时需要epub作为转换来源
+    def is_build_epub(self):
+        return cfg.get(cfg.isSaveEpub) or (cfg.get(cfg.isSaveMobi) and not cfg.get(cfg.isSaveCbz))
+
+    # 是否边下载边写入epub/cbz，需要合并PDF时仍然先保存图片；
+    # 边下载边写入时继续下载只能从图片缓存读取已完成的页面，关闭图片缓存时也先保存图片，按页面清单续传
+    def is_stream_pages(self):
+        return (cfg.get(cfg.isStreamEpub) and (self.is_build_epub() or cfg.get(cfg.isSaveCbz))
+                and not cfg.get(cfg.isSavePdf) and cfg.get(cfg.imageCacheSize) > 0)
+
+    # 创建章节的epub/cbz写入器
+    def open_page_writers(self, comic_id, comic_name, comic_author, chapter_name, page_count):
+        save_path = chapter_save_path(cfg.get(cfg.downloadFolder), comic_name, chapter_name,
+                                      cfg.get(cfg.epubSaveFolder))
+        os.makedirs(save_path, exist_ok=True)
+        writers = []
+        if self.is_build_epub():
+            writers.append(StreamingEpubWriter(os.path.join(save_path, f'{comic_name}_{chapter_name}.epub'),
+                                               comic_id, chapter_name, comic_author))
+        if cfg.get(cfg.isSaveCbz):
+            writers.append(CbzWriter(os.path.join(save_path, f'{comic_name}_{chapter_name}.cbz'),
+                                     comic_name, chapter_name, comic_author, page_count))
+        return writers
 
     # 下载章节图片
     async def start_download_chapter(self, chapters, comic_path_word, comic_name, comic_author):
-        async with aiohttp.ClientSession() as session:
-            sqlite_util = SQLiteDatabase()
-            try:
-                chapter_tasks = []
-                id_map = {}
-                for chapter in chapters:
+        sqlite_util = SQLiteDatabase()
+        try:
+            # 读取页面清单前先写入还在队列中的数据
+            await progress_writer.flush_async()
+            id_map = {}
+            queued_chapters = []
+            for chapter in chapters:
+                # 未完成的章节沿用原下载记录，按页面清单续传
+                history = sqlite_util.query_data('cmbok_download_history',
+                                                 {'key': comic_path_word, 'chapter_path_word': chapter['id'],
+                                                  'type': 1, 'status': ('<=', 4)},
+                                                 order_by='id DESC', limit=1)
+                if history and history[0].status != 3:
+                    history_id = history[0].id
+                    # 已在队列或下载中的章节不重复下载，也不修改其状态
+                    if not download_scheduler.enqueue(history_id, history[0].priority or 0):
+                        continue
+                    sqlite_util.update_data('cmbok_download_history', {'status': 2, 'start_time': ''},
+                                            {'id': history_id})
+                else:
                     # 先保存保存下载记录
                     history_id = sqlite_util.insert_data('cmbok_download_history', {'cover': '',
                                                                                     'name': comic_name,
@@ -441,169 +992,289 @@ class ComicDownload(QThread):
                                                                                     'status': 2,
                                                                                     'process': 0,
                                                                                     'type': 1,
+                                                                                    'priority': 0,
                                                                                     'start_time': ''})
-                    id_map[comic_path_word + chapter['id']] = history_id
-
-                for chapter in chapters:
-                    chapter_images = self.get_chapter_images(comic_path_word, chapter['id'])
-
-                    if chapter_images is not None:
-                        shared_data = {'process': 0}
-                        # 每次同时下载指定数量的章节
-                        task = asyncio.create_task(
-                            self.start_download_chapter_images(id_map[comic_path_word + chapter['id']], chapter_images,
-                                                               comic_path_word, comic_name,
-                                                               comic_author,
-                                                               chapter['name'], shared_data))
-                        chapter_tasks.append(task)
-                        # 下载记录更新状态
-                        sqlite_util.update_data('cmbok_download_history',
-                                                {'status': 1, 'start_time': get_current_time()},
-                                                {'id': id_map[comic_path_word + chapter['id']]})
-                        download_signals.success.emit('update', comic_name, chapter['name'], 1)
-                        # 如果达到并发章节限制，则等待当前任务完成
-                        if len(chapter_tasks) >= cfg.get(cfg.downloadThreadNum):
-                            # 等待第一个完成的任务
-                            done, pending = await asyncio.wait(chapter_tasks, return_when=asyncio.FIRST_COMPLETED)
-                            for completed in done:
-                                chapter_tasks.remove(completed)  # 移除已完成的任务
-                    else:
-                        # 下载记录更新状态
-                        sqlite_util.update_data('cmbok_download_history',
-                                                {'status': -2},
-                                                {'id': id_map[comic_path_word + chapter['id']]})
-                        download_signals.success.emit('fail', comic_name, chapter['name'], 1)
-
-                # 等待剩余的任务完成
-                if chapter_tasks:
-                    await asyncio.gather(*chapter_tasks)
+                    download_scheduler.enqueue(history_id, 0)
+                id_map[comic_path_word + chapter['id']] = history_id
+                queued_chapters.append(chapter)
+
+            job_queue = self.get_job_queue()
+            chapter_tasks = []
+            # 后台并发解析章节图片列表，解析完一个章节就等待调度器分配下载名额
+            chapter_queue = asyncio.Queue()
+            resolver = asyncio.create_task(self.resolve_chapters(queued_chapters, comic_path_word, chapter_queue))
+            while True:
+                item = await chapter_queue.get()
+                if item is None:
+                    break
+                chapter, chapter_images = item
+                history_id = id_map[comic_path_word + chapter['id']]
+
+                if chapter_images:
+                    chapter_tasks.append(asyncio.create_task(self.download_scheduled_chapter(
+                        history_id, chapter, chapter_images, job_queue, comic_path_word, comic_name, comic_author)))
+                else:
+                    download_scheduler.discard(history_id)
+                    # 下载记录更新状态
+                    sqlite_util.update_data('cmbok_download_history',
+                                            {'status': -2},
+                                            {'id': history_id})
+                    progress_events.notify('fail', comic_name, chapter['name'], 1)
+
+            await resolver
+            # 等待剩余的章节完成
+            await asyncio.gather(*chapter_tasks)
+        except Exception:
+            progress_events.notify('fail', comic_name, chapter['name'], 1)
+            logging.info(traceback.format_exc())
+            logging.info('下载异常')
+        finally:
+            sqlite_util.close()
+
+    # 等待调度器分配下载名额后开始下载章节，章节结束后释放名额
+    async def download_scheduled_chapter(self, history_id, chapter, chapter_images, job_queue, comic_path_word,
+                                         comic_name, comic_author):
+        if not await download_scheduler.acquire(history_id):
+            # 等待时被暂停或取消
+            return
+        try:
+            logging.info(f'{comic_name}{chapter["name"]}图片开始下载')
+            path = f"{cfg.get(cfg.downloadFolder)}/{comic_name}/{chapter['name']}"
+            stream_pages = self.is_stream_pages()
+            with SQLiteDatabase() as db:
+                # 边下载边写入时epub/cbz需要重新生成，已完成的页面从缓存读取
+                finished_pages, processed = ({}, set()) if stream_pages else self.load_finished_pages(
+                    db, history_id, path, chapter_images)
+            job = ChapterJob(history_id, chapter['name'], chapter_images, path, finished_pages, processed)
+            job.comic = (comic_path_word, comic_name, comic_author)
+            job.cleanup = self.get_cleanup_options()
+            job.transcode = self.get_transcode_options()
+            if stream_pages:
+                job.writers = self.open_page_writers(comic_path_word, comic_name, comic_author,
+                                                     chapter['name'], len(chapter_images))
+            else:
+                os.makedirs(path, exist_ok=True)
+            self.write_page_manifest(job, chapter_images)
+            # 下载记录更新状态
+            with SQLiteDatabase() as db:
+                db.update_data('cmbok_download_history',
+                               {'status': 1, 'process': job.process, 'start_time': get_current_time()},
+                               {'id': history_id})
+            progress_events.notify('update', comic_name, chapter['name'], 1)
+            if job.pending:
+                await job_queue.put(job)
+            else:
+                # 所有页面上次已下载完成，直接打包
+                self.chapter_downloaded(job, comic_path_word, comic_name, comic_author)
+            await job.done
+        except Exception:
+            logging.info(traceback.format_exc())
+            logging.info(f'{comic_name}{chapter["name"]}下载异常')
+            with SQLiteDatabase() as db:
+                db.update_data('cmbok_download_history', {'status': 0}, {'id': history_id})
+            progress_events.notify('fail', comic_name, chapter['name'], 1)
+        finally:
+            download_scheduler.release(history_id)
+
+    # 图片下载协程，空闲时从进度最落后的章节取任务，章节图片全部结束后提交后期处理
+    async def image_worker(self, job_queue):
+        while True:
+            item = await job_queue.get()
+            if item is None:
+                return
+            job, index, url = item
+            # 章节已异常结束时跳过剩余的图片
+            if job.done.done():
+                continue
+            try:
+                # 章节已暂停或取消时跳过剩余的图片
+                if not download_scheduler.is_stopped(job.history_id):
+                    await self.async_download_image(url, job, index)
+                job.finished += 1
+                if job.finished == job.total:
+                    await self.pages_ended(job, job_queue, *job.comic)
             except Exception:
-                download_signals.success.emit('fail', comic_name, chapter['name'], 1)
+                # 单个章节出错不影响共享的下载协程继续处理其他章节
                 logging.info(traceback.format_exc())
-                logging.info('下载异常')
-            finally:
-                sqlite_util.close()
-
-    async def start_download_chapter_images(self, history_id, chapter_images, comic_path_word, comic_name, comic_author,
-                                            chapter_name, shared_data):
-        tasks = [self.download_chapter_images(history_id, chapter_images, comic_path_word, comic_name, comic_author,
-                                              chapter_name, shared_data)]
-        await asyncio.gather(*tasks)
-
-    async def download_chapter_images(self, history_id, image_urls, comic_id, comic_name, comic_author, chapter_name,
-                                      shared_data):
-        logging.info(f'{comic_name}{chapter_name}图片开始下载')
-        download_folder = cfg.get(cfg.downloadFolder)
-        path = f"{download_folder}/{comic_name}/{chapter_name}"
-        os.makedirs(path, exist_ok=True)
-        process = int(100 / len(image_urls))
-        tasks = [
-            self.async_download_image(url, path, 'Cmbok_' + str(index) + os.path.splitext(url)[1], history_id,
-                                      shared_data, process)
-            for
-            index, url in
-            enumerate(image_urls)]
-        await asyncio.gather(*tasks)
-        logging.info(f'{comic_name}{chapter_name}图片下载完成')
-        # 下载完成，合并epub
-        self.images_to_epub(history_id, download_folder, comic_id, comic_name, comic_author, chapter_name)
-
-    # 下载章节图片
+                self.chapter_failed(job)
+
+    # 一轮下载结束，有可重试的失败图片时等待后重新加入队列，重试轮数用完或全部成功时开始打包
+    async def pages_ended(self, job, job_queue, comic_id, comic_name, comic_author):
+        if download_scheduler.is_stopped(job.history_id):
+            await self.chapter_stopped(job)
+        elif job.failed and job.retry_rounds < CHAPTER_RETRY_ROUNDS:
+            job.retry_rounds += 1
+            job.retry_task = asyncio.create_task(self.retry_failed_pages(job, job_queue))
+        else:
+            self.chapter_downloaded(job, comic_id, comic_name, comic_author)
 
-    # 生成epub
-    def images_to_epub(self, history_id, download_folder, comic_id, comic_name, comic_author, chapter_name):
+    # 等待退避时间后重新下载失败的图片，期间其他章节继续下载
+    async def retry_failed_pages(self, job, job_queue):
+        # 重试任务没有其他协程等待，异常时在这里结束章节，避免章节一直等待
+        try:
+            # retry_rounds已加一，第1、2、3轮的等待上限为4、8、16秒
+            delay = job.retry_policy.backoff(job.retry_rounds + 1)
+            logging.info(f'{job.chapter_name}有{len(job.failed)}张图片下载失败，{delay:.1f}秒后第{job.retry_rounds}轮重试')
+            await asyncio.sleep(delay)
+            if download_scheduler.is_stopped(job.history_id):
+                await self.chapter_stopped(job)
+                return
+            job.finished -= len(job.failed)
+            job.pending.extend(job.failed)
+            job.failed = []
+            await job_queue.put(job)
+        except Exception:
+            logging.info(traceback.format_exc())
+            self.chapter_failed(job)
+
+    # 章节被暂停或取消，暂停时保留已下载的图片和页面清单，继续下载时续传
+    async def chapter_stopped(self, job):
+        for writer in job.writers:
+            writer.abort()
+        status = download_scheduler.stopped_status(job.history_id)
+        if status == STATUS_CANCELLED:
+            await asyncio.get_running_loop().run_in_executor(None, clear_chapter_files, job.history_id, job.path)
+        # 状态排在还在队列中的进度之后写入
+        progress_writer.update(job.history_id, {'status': status})
+        await progress_writer.flush_async()
+        logging.info(f'{job.chapter_name}已停止下载')
+        job.done.set_result(False)
+
+    # 章节下载异常，标记为失败并结束章节，释放下载名额
+    def chapter_failed(self, job):
+        logging.info(f'{job.chapter_name}下载异常')
+        for writer in job.writers:
+            try:
+                writer.abort()
+            except Exception:
+                logging.info(traceback.format_exc())
+        progress_writer.update(job.history_id, {'status': 0})
+        progress_events.notify('fail', job.comic[1], job.chapter_name, 1)
+        if not job.done.done():
+            job.done.set_result(False)
+
+    # 章节图片全部结束，后台合并epub，当前协程继续下载
+    def chapter_downloaded(self, job, comic_id, comic_name, comic_author):
+        logging.info(f'{comic_name}{job.chapter_name}图片下载完成')
+        task = asyncio.create_task(self.post_process_chapter(job, comic_id, comic_name, comic_author))
+        task.add_done_callback(lambda t, j=job: j.done.done() or j.done.set_result(True))
+
+    # 章节后期处理，提交到进程池执行，不阻塞其他章节的下载
+    async def post_process_chapter(self, job, comic_id, comic_name, comic_author):
+        chapter_name = job.chapter_name
         logging.info(f'{comic_name}{chapter_name}开始转换epub')
-        sqlite_util = SQLiteDatabase()
+        options = {'comic_id': comic_id,
+                   'comic_name': comic_name,
+                   'comic_author': comic_author,
+                   'chapter_name': chapter_name,
+                   'download_folder': cfg.get(cfg.downloadFolder),
+                   'epub_save_folder': cfg.get(cfg.epubSaveFolder),
+                   'is_save_epub': self.is_build_epub(),
+                   'is_save_cbz': cfg.get(cfg.isSaveCbz),
+                   'is_save_pdf': cfg.get(cfg.isSavePdf),
+                   'is_del_chapter_images': cfg.get(cfg.isDelChapterImages)}
+        # 各阶段耗时（秒）、排队情况、缺失的图片数量和重试轮数
+        missing = len(job.failed) + job.lost
+        stage_info = {'download': round(time.monotonic() - job.start_time, 2),
+                      'missing': missing, 'retry_rounds': job.retry_rounds}
         try:
-            book = epub.EpubBook()
-            book.set_identifier(str(comic_id))
-            book.set_title(chapter_name)
-            book.set_language('en')
-            book.add_author(comic_author)
-            path = f"{download_folder}/{comic_name}/{chapter_name}"
-            # 获取目录下的所有文件
-            files = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))]
-            # 进行自然排序
-            sorted_files = natsorted(files)
-            # 漫画图片目录
-            for index, file_name in enumerate(sorted_files):
-                img_item = epub.EpubItem(uid=file_name, file_name=file_name,
-                                         media_type='image/jpeg')
-                with open(f'{path}/{file_name}', 'rb') as f:
-                    img_item.set_content(f.read())
-                    if index == 0:
-                        book.add_item(epub.EpubItem(uid="cover", file_name=file_name,
-                                                    media_type='image/jpeg',
-                                                    content=f.read()))
-                book.add_item(img_item)
-
-                chapter = epub.EpubHtml(title=f'Image {index}', file_name=f'chap_{index}.xhtml', lang='en')
-                chapter.set_content(f'<html><body><img src="{img_item.file_name}" /></body></html>')
-                book.add_item(chapter)
-                book.spine.append(chapter)
-            nav = epub.EpubNav()
-            book.add_item(nav)
-
-            # epub是否保存到漫画根目录
-            epubSaveFolder = cfg.get(cfg.epubSaveFolder)
-            if epubSaveFolder:
-                save_path = f"{download_folder}/{comic_name}"
+            if job.writers:
+                # 图片已经写入epub/cbz，只需写入目录
+                stage_start = time.monotonic()
+                for writer in job.writers:
+                    writer.close()
+                timings, queue_depth, wait = {'package': round(time.monotonic() - stage_start, 2)}, 0, 0
             else:
-                save_path = f"{path}"
-            epub.write_epub(os.path.join(save_path, f'{comic_name}_{chapter_name}.epub'), book)
-
-            # 更新下载记录
-            sqlite_util.update_data('cmbok_download_history', {'status': 3, 'process': 100,
-                                                               'finish_time': get_current_time()},
-                                    {'id': history_id})
-
-            # 是否生成pdf
-            isSavePdf = cfg.get(cfg.isSavePdf)
-            if isSavePdf:
-                img_to_pdf(sorted_files, path, f'{save_path}/{comic_name}_{chapter_name}.pdf')
-
+                # 先裁剪、拆分，再按设备转码
+                if job.cleanup is not None:
+                    stage_start = time.monotonic()
+                    results = await self.process_chapter_images(job, clean_page_files, job.cleanup)
+                    stage_info['cleanup'] = round(time.monotonic() - stage_start, 2)
+                    stage_info['split'] = sum(split for changed, split in results)
+                if job.transcode is not None:
+                    stage_start = time.monotonic()
+                    await self.process_chapter_images(job, transcode_files, *job.transcode)
+                    stage_info['transcode'] = round(time.monotonic() - stage_start, 2)
+                if job.cleanup is not None or job.transcode is not None:
+                    # 记录已处理的页面，继续下载时不再重复裁剪、转码
+                    progress_writer.execute('UPDATE cmbok_download_page SET processed = 1 '
+                                            'WHERE history_id = ? AND state = 1;', (job.history_id,))
+                timings, queue_depth, wait = await post_process_stage.run(package_chapter, options)
+            stage_info.update(timings, queue_depth=queue_depth, wait=wait)
             # 是否转换mobi
             if cfg.get(cfg.isSaveMobi):
-                # 先生成pdf
-                if not isSavePdf:
-                    img_to_pdf(sorted_files, path, f'{save_path}/{comic_name}_{chapter_name}.pdf')
-                # 转mobi，需要配置ebook-convert
-                calibrePath = cfg.get(cfg.calibrePath)
-                if calibrePath != '' and os.path.isfile(calibrePath) and os.path.basename(
-                        calibrePath) == 'ebook-convert.exe':
-                    convert_epub_to_mobi(calibrePath, cfg.get(cfg.calibreOutputDevice),
-                                         f'{comic_name}_{chapter_name}', f'{save_path}/{comic_name}_{chapter_name}.pdf',
-                                         f'{save_path}/{comic_name}_{chapter_name}.mobi')
-                    # 转换完成删除pdf
-                    if not isSavePdf:
-                        del_file(f'{save_path}/{comic_name}_{chapter_name}.pdf')
-
-            # 合并epub之后，根据配置是否删除章节图片
-            if cfg.get(cfg.isDelChapterImages):
-                if epubSaveFolder:
-                    del_folder(path)
-                else:
-                    del_folder_images(path)
-
-            download_signals.success.emit('success', comic_name, chapter_name, 1)
+                stage_info.update(await self.convert_chapter(comic_name, chapter_name))
+            # 先写入还在队列中的进度，避免覆盖最终状态
+            await progress_writer.flush_async()
+            with SQLiteDatabase() as db:
+                # 更新下载记录
+                db.update_data('cmbok_download_history', {'status': 3 if missing == 0 else -4, 'process': 100,
+                                                          'finish_time': get_current_time(),
+                                                          'stage_info': json.dumps(stage_info)},
+                               {'id': job.history_id})
+            progress_events.notify('success' if missing == 0 else 'fail', comic_name, chapter_name, 1)
         except Exception:
-            sqlite_util.rollback()
-            # 下载记录更新状态
-            sqlite_util.update_data('cmbok_download_history',
-                                    {'status': -1},
-                                    {'id': history_id})
             logging.info(traceback.format_exc())
             logging.info('保存下载记录异常')
-        finally:
-            sqlite_util.close()
+            for writer in job.writers:
+                writer.abort()
+            await progress_writer.flush_async()
+            with SQLiteDatabase() as db:
+                # 下载记录更新状态
+                db.update_data('cmbok_download_history', {'status': -1, 'stage_info': json.dumps(stage_info)},
+                               {'id': job.history_id})
         logging.info(f'{comic_name}{chapter_name}转换epub完成')
 
-    def get_chapter_images(self, book_name, chapter_id):
+    # 用epub或cbz转换mobi/azw3，在calibre转换队列中执行，返回转换耗时
+    async def convert_chapter(self, comic_name, chapter_name):
+        # 转mobi，需要配置ebook-convert
+        calibre_path = cfg.get(cfg.calibrePath)
+        if not is_calibre_executable(calibre_path):
+            logging.info('未配置ebook-convert，跳过转换')
+            return {}
+        save_path = chapter_save_path(cfg.get(cfg.downloadFolder), comic_name, chapter_name,
+                                      cfg.get(cfg.epubSaveFolder))
+        epub_file = f'{save_path}/{comic_name}_{chapter_name}.epub'
+        source = epub_file if os.path.isfile(epub_file) else f'{save_path}/{comic_name}_{chapter_name}.cbz'
+        output_format = cfg.get(cfg.calibreOutputFormat)
+        stage_start = time.monotonic()
+        converted = await calibre_pool.convert(calibre_path, cfg.get(cfg.calibreOutputDevice),
+                                               f'{comic_name}_{chapter_name}', source,
+                                               f'{save_path}/{comic_name}_{chapter_name}.{output_format}')
+        # 只为转换生成的epub，转换完成后删除
+        if source == epub_file and not cfg.get(cfg.isSaveEpub):
+            del_file(epub_file)
+        return {output_format: round(time.monotonic() - stage_start, 2), 'converted': converted}
+
+    # 获取章节图片列表，页面解析和解密在线程池中执行，不阻塞事件循环
+    async def get_chapter_images(self, book_name, chapter_id, retry_policy):
         try:
-            response = requests.get(f"{URL}/comic/{book_name}/chapter/{chapter_id}").content
-            data = analyze_data(
-                BeautifulSoup(response, 'html.parser').find(name="div", attrs={"class": "imageData"}).attrs[
-                    'contentkey'])
-            return [i['url'] for i in data]
+            response = await retry_policy.call(self.fetch_chapter_page, book_name, chapter_id)
+            return await asyncio.get_running_loop().run_in_executor(None, parse_chapter_images, response)
         except Exception as e:
+            logging.info(traceback.format_exc())
             logging.info('获取图片失败')
+
+    async def fetch_chapter_page(self, book_name, chapter_id):
+        async with get_session().get(f"{URL}/comic/{book_name}/chapter/{chapter_id}",
+                                     timeout=aiohttp.ClientTimeout(total=60)) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    # 并发解析章节图片列表，解析完成的章节放入队列，全部完成后放入None
+    async def resolve_chapters(self, chapters, comic_path_word, chapter_queue):
+        sem = self.resolve_sem
+        retry_policy = RetryPolicy(budget=max(20, len(chapters)))
+
+        async def resolve(chapter):
+            async with sem:
+                chapter_images = await self.get_chapter_images(comic_path_word, chapter['id'], retry_policy)
+            await chapter_queue.put((chapter, chapter_images))
+
+        try:
+            await asyncio.gather(*[resolve(chapter) for chapter in chapters])
+        finally:
+            await chapter_queue.put(None)
+
+
+comic_download = ComicDownload()
@@ -47,9 +47,6 @@ class ComicInterface(ScrollArea):
         elif status == 'error':
             info_bar_tip(InfoBarIcon.ERROR, '温馨提示', '下载失败，(。・＿・。)ﾉI’m sorry~', self,
                          InfoBarPosition.TOP_RIGHT)
-        elif status == 'lock':
-            info_bar_tip(InfoBarIcon.WARNING, '温馨提示', '前一个任务还在下载，请等会再下载吧(*￣︶￣)', self,
-                         InfoBarPosition.TOP_RIGHT)
 
 
 class BannerWidget(QWidget):
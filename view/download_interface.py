@@ -12,35 +12,24 @@ from qfluentwidgets import ScrollArea, SearchLineEdit, SegmentedToolWidget, Flue
     RoundMenu, Action, ProgressRing
 
 from common.config import cfg
+from common.download_scheduler import download_scheduler
 from common.sqlite_util import SQLiteDatabase
 from common.style_sheet import StyleSheet
+from common.util import format_speed, format_duration
 from common.view_util import info_bar_tip
 from custom.my_fluent_icon import MyFluentIcon
 
 
 # 定义全局信号槽类
+# 下载进度和状态批量通知：{下载记录id: ProgressSnapshot}, [(状态, 名称, 章节名称, 类型)]
 class DownloadSignals(QObject):
-    success = pyqtSignal(object, object, object, object)  # 定义信号
+    success = pyqtSignal(object, object)  # 定义信号
 
 
 # 创建全局信号槽实例
 download_signals = DownloadSignals()
 
 
-class BookProcessSignals(QObject):
-    success = pyqtSignal(object, object)  # 定义信号
-
-
-book_process_signals = BookProcessSignals()
-
-
-class ComicProcessSignals(QObject):
-    success = pyqtSignal(object, object)  # 定义信号
-
-
-comic_process_signals = ComicProcessSignals()
-
-
 class DownloadInterface(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent=parent)
@@ -90,15 +79,26 @@ class DownloadInterface(QWidget):
         else:
             self.bookAreaInterface.banner.search(None)
 
-    # 下载完成
-    def downloadFinish(self, status, name, chapter_name, type=1):
-        if status == 'success':
-            info_bar_tip(InfoBarIcon.SUCCESS, '温馨提示', f"{name}-{chapter_name}下载完成，o(￣▽￣)ｄ", self,
-                         InfoBarPosition.TOP_RIGHT)
-        elif status == 'fail':
-            info_bar_tip(InfoBarIcon.ERROR, '温馨提示', f"{name}-{chapter_name}下载失败，(꒦_꒦)", self,
+    # 下载完成，同一批通知中有多个任务完成时合并提示，每种类型只刷新一次下载记录
+    def downloadFinish(self, snapshots, events):
+        if not events:
+            return
+        finished = [event for event in events if event[0] in ('success', 'fail', 'error')]
+        if len(finished) == 1:
+            status, name, chapter_name, type = finished[0]
+            if status == 'success':
+                info_bar_tip(InfoBarIcon.SUCCESS, '温馨提示', f"{name}-{chapter_name}下载完成，o(￣▽￣)ｄ", self,
+                             InfoBarPosition.TOP_RIGHT)
+            elif status == 'fail':
+                info_bar_tip(InfoBarIcon.ERROR, '温馨提示', f"{name}-{chapter_name}下载失败，(꒦_꒦)", self,
+                             InfoBarPosition.TOP_RIGHT)
+        elif finished:
+            success_count = len([event for event in finished if event[0] == 'success'])
+            info_bar_tip(InfoBarIcon.INFORMATION, '温馨提示',
+                         f"{success_count}个任务下载完成，{len(finished) - success_count}个任务下载失败", self,
                          InfoBarPosition.TOP_RIGHT)
-        self.updateComicRecords(type)
+        for type in sorted({event[3] for event in events}):
+            self.updateComicRecords(type)
 
 
 # 下载窗口
@@ -143,10 +143,7 @@ class DownloadWidget(QWidget):
         self.vBoxLayout.addWidget(self.lineEdit, alignment=Qt.AlignCenter)
 
         # 下载进度更新
-        if type == 2:
-            book_process_signals.success.connect(self.updateProcess)
-        else:
-            comic_process_signals.success.connect(self.updateProcess)
+        download_signals.success.connect(self.updateProcess)
 
         # 下载记录表格
         # 启用边框并设置圆角
@@ -191,21 +188,26 @@ class DownloadWidget(QWidget):
         self.vBoxLayout.addStretch(1)
         self.vBoxLayout.addWidget(self.pager, alignment=Qt.AlignCenter)
 
-    # 下载进度更新
-    def updateProcess(self, history_id, new_process):
-        row_count = self.tableWidget.rowCount()
-        for row in range(row_count):
+    # 下载进度更新，每批通知只遍历一次表格
+    def updateProcess(self, snapshots, events):
+        if not snapshots:
+            return
+        process_column = 5 if self.type == 1 else 4
+        for row in range(self.tableWidget.rowCount()):
             item = self.tableWidget.item(row, 0)
-            if item and item.text() == str(history_id):
-                if self.type == 1:
-                    widgt = self.tableWidget.cellWidget(row, 5)
-                    ring = widgt.findChild(ProgressRing)
-                    ring.setValue(new_process)
-                else:
-                    widgt = self.tableWidget.cellWidget(row, 4)
-                    ring = widgt.findChild(ProgressRing)
-                    ring.setValue(new_process)
-                return
+            snapshot = snapshots.get(int(item.text())) if item else None
+            if snapshot is None or snapshot.type != self.type:
+                continue
+            widgt = self.tableWidget.cellWidget(row, process_column)
+            ring = widgt.findChild(ProgressRing)
+            ring.setValue(snapshot.process)
+            # 下载中显示速度和预计剩余时间
+            status_item = self.tableWidget.item(row, process_column - 1)
+            if status_item is not None and status_item.text().startswith('下载中') and snapshot.speed:
+                text = f'下载中 {format_speed(snapshot.speed)}'
+                if snapshot.eta is not None:
+                    text += f' 剩余{format_duration(snapshot.eta)}'
+                status_item.setText(text)
 
     # 表格右键操作
     def contextMenuEvent(self, event):
@@ -230,8 +232,25 @@ class DownloadWidget(QWidget):
                 menu.addAction(
                     Action(FluentIcon.FOLDER, '打开图书目录', triggered=lambda: self.openFolder('')))
 
-            # menu.addAction(
-            #    Action(FluentIcon.DOWNLOAD, '重新下载', triggered=lambda: self.againDownload(id)))
+            # 暂停、继续、取消和调整优先级
+            with SQLiteDatabase() as db:
+                history = db.query_first_data('cmbok_download_history', {'id': id})
+            if history is not None:
+                if history.status in (1, 2):
+                    menu.addAction(
+                        Action(FluentIcon.PAUSE, '暂停', triggered=lambda: self.pauseDownload(history.id)))
+                elif history.status != 3:
+                    menu.addAction(
+                        Action(FluentIcon.DOWNLOAD, '继续下载', triggered=lambda: self.resumeDownload(history.id)))
+                if history.status in (1, 2, 4):
+                    menu.addAction(
+                        Action(FluentIcon.CLOSE, '取消下载', triggered=lambda: self.cancelDownload(history.id)))
+                if history.status != 3:
+                    priority = history.priority or 0
+                    menu.addAction(Action(FluentIcon.UP, '提高优先级',
+                                          triggered=lambda: self.setPriority(history.id, priority + 1)))
+                    menu.addAction(Action(FluentIcon.DOWN, '降低优先级',
+                                          triggered=lambda: self.setPriority(history.id, priority - 1)))
 
             menu.addAction(
                 Action(FluentIcon.DELETE, '删除下载记录', triggered=lambda: self.delRecord(id)))
@@ -249,6 +268,8 @@ class DownloadWidget(QWidget):
     def delErrorRecord(self):
         sqlite_util = SQLiteDatabase()
         try:
+            # 删除记录前先取消任务，删除临时文件和断点续传记录
+            self.cancelRecords(sqlite_util.query_data('cmbok_download_history', {'status': ('<=', 0)}))
             sqlite_util.delErrorRecord('cmbok_download_history')
             self.search(self.lineEdit.text())
             info_bar_tip(InfoBarIcon.SUCCESS, '温馨提示', '清空记录成功', self)
@@ -264,6 +285,8 @@ class DownloadWidget(QWidget):
     def delAllRecord(self):
         sqlite_util = SQLiteDatabase()
         try:
+            # 停止还在下载或等待的任务，删除临时文件和断点续传记录
+            self.cancelRecords(sqlite_util.query_data('cmbok_download_history', {'type': self.type}))
             sqlite_util.delete_data('cmbok_download_history', {'type': self.type})
             self.search(self.lineEdit.text())
             info_bar_tip(InfoBarIcon.SUCCESS, '温馨提示', '清空记录成功', self)
@@ -275,10 +298,17 @@ class DownloadWidget(QWidget):
         finally:
             sqlite_util.close()
 
+    # 取消要删除的下载记录对应的任务
+    def cancelRecords(self, historys):
+        for history in historys:
+            download_scheduler.cancel(history.id)
+
     # 删除下载记录
     def delRecord(self, id):
         sqlite_util = SQLiteDatabase()
         try:
+            # 停止还在下载或等待的任务，删除临时文件和断点续传记录
+            download_scheduler.cancel(int(id))
             sqlite_util.delete_data('cmbok_download_history', {'id': id})
             self.search(self.lineEdit.text())
             info_bar_tip(InfoBarIcon.SUCCESS, '温馨提示', '删除记录成功', self)
@@ -290,6 +320,27 @@ class DownloadWidget(QWidget):
         finally:
             sqlite_util.close()
 
+    # 暂停下载，下载中的任务保留已下载的部分
+    def pauseDownload(self, id):
+        download_scheduler.pause(id)
+        self.search(self.lineEdit.text())
+
+    # 继续下载，从上次停止的位置续传
+    def resumeDownload(self, id):
+        download_scheduler.resume(id)
+        self.search(self.lineEdit.text())
+        info_bar_tip(InfoBarIcon.INFORMATION, '温馨提示', '已加入下载队列', self)
+
+    # 取消下载
+    def cancelDownload(self, id):
+        download_scheduler.cancel(id)
+        self.search(self.lineEdit.text())
+
+    # 调整优先级，等待中的任务按优先级从高到低开始下载
+    def setPriority(self, id, priority):
+        download_scheduler.set_priority(id, priority)
+        info_bar_tip(InfoBarIcon.SUCCESS, '温馨提示', f'优先级已调整为{priority}', self)
+
     # 打开漫画/章节目录
     def openFolder(self, name, chapter_name=''):
         folder_path = os.path.join(cfg.get(cfg.downloadFolder), name, chapter_name)
@@ -375,12 +426,12 @@ class DownloadWidget(QWidget):
             # 添加表格数据
             for i, history in enumerate(historys):
                 status_item = QTableWidgetItem(
-                    '软件退出' if history.status == -3 else '无法下载' if history.status == -2 else '转换epub失败' if history.status == -1 else '下载中' if history.status == 1 else '等待中' if history.status == 2 else '已完成' if history.status == 3 else '下载失败')
-                if history.status == -3 or history.status == -2 or history.status == -1 or history.status == 0:
+                    '已取消' if history.status == -5 else '页面缺失' if history.status == -4 else '软件退出' if history.status == -3 else '无法下载' if history.status == -2 else '转换epub失败' if history.status == -1 else '下载中' if history.status == 1 else '等待中' if history.status == 2 else '已完成' if history.status == 3 else '已暂停' if history.status == 4 else '下载失败')
+                if history.status == -4 or history.status == -3 or history.status == -2 or history.status == -1 or history.status == 0:
                     status_item.setForeground(QBrush(QColor(253, 46, 86)))  # 红色字体
                 elif history.status == 1:
                     status_item.setForeground(QBrush(QColor(64, 158, 215)))  # 蓝色字体
-                elif history.status == 2:
+                elif history.status == 2 or history.status == 4 or history.status == -5:
                     status_item.setForeground(QBrush(QColor(198, 202, 219)))  # 灰色字体
                 elif history.status == 3:
                     status_item.setForeground(QBrush(QColor(19, 210, 105)))  # 绿色字体
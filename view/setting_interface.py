@@ -52,6 +52,24 @@ class SettingInterface(ScrollArea):
             self.useSettingGroup
         )
 
+        self.bookSpeedLimitCard = ComboBoxSettingCard(
+            cfg.bookSpeedLimit,
+            FIF.SPEED_MEDIUM,
+            '图书下载限速',
+            '所有图书下载共享此速度上限，修改后正在下载的任务立即生效',
+            texts=['不限速', '256KB/s', '512KB/s', '1MB/s', '2MB/s', '5MB/s', '10MB/s', '20MB/s'],
+            parent=self.useSettingGroup
+        )
+
+        self.comicSpeedLimitCard = ComboBoxSettingCard(
+            cfg.comicSpeedLimit,
+            FIF.SPEED_MEDIUM,
+            '漫画下载限速',
+            '所有漫画下载共享此速度上限，修改后正在下载的任务立即生效',
+            texts=['不限速', '256KB/s', '512KB/s', '1MB/s', '2MB/s', '5MB/s', '10MB/s', '20MB/s'],
+            parent=self.useSettingGroup
+        )
+
         self.downloadFolderCard = PushSettingCard(
             '选择文件夹',
             FIF.DOWNLOAD,
@@ -80,6 +98,30 @@ class SettingInterface(ScrollArea):
             parent=self.comicSettingGroup
         )
 
+        self.isSaveEpubCard = SwitchSettingCard(
+            FIF.BOOK_SHELF,
+            '是否生成epub',
+            '如果开启，会把章节图片合并成一个epub文件',
+            configItem=cfg.isSaveEpub,
+            parent=self.comicSettingGroup
+        )
+
+        self.isSaveCbzCard = SwitchSettingCard(
+            FIF.PHOTO,
+            '是否生成cbz',
+            '如果开启，会把章节图片打包成一个cbz文件，生成速度最快',
+            configItem=cfg.isSaveCbz,
+            parent=self.comicSettingGroup
+        )
+
+        self.isStreamEpubCard = SwitchSettingCard(
+            FIF.ZIP_FOLDER,
+            '边下载边写入epub/cbz',
+            '如果开启，图片下载后直接写入epub/cbz，不保存章节图片，转换Mobi时使用写入的文件；需要合并PDF或关闭图片缓存时不生效',
+            configItem=cfg.isStreamEpub,
+            parent=self.comicSettingGroup
+        )
+
         self.isSavePdfCard = SwitchSettingCard(
             MyFluentIcon.PDF,
             '是否合并保存PDF',
@@ -99,7 +141,7 @@ class SettingInterface(ScrollArea):
         self.calibrePathCard = PushSettingCard(
             '选择文件',
             FIF.TILES,
-            'ebook-convert.exe路径，如果开启转换Mobi，需要先安装Calibre',
+            'ebook-convert路径，如果开启转换Mobi，需要先安装Calibre',
             cfg.get(cfg.calibrePath),
             self.comicSettingGroup
         )
@@ -121,6 +163,64 @@ class SettingInterface(ScrollArea):
             parent=self.comicSettingGroup
         )
 
+        self.calibreOutputFormatCard = ComboBoxSettingCard(
+            cfg.calibreOutputFormat,
+            FIF.SAVE_AS,
+            '转换格式',
+            '由epub（未生成epub时使用cbz）转换，不再生成中间PDF',
+            texts=['mobi', 'azw3'],
+            parent=self.comicSettingGroup
+        )
+
+        self.imageCacheSizeCard = ComboBoxSettingCard(
+            cfg.imageCacheSize,
+            FIF.CLOUD_DOWNLOAD,
+            '图片缓存容量',
+            '下载过的图片按内容缓存，重复下载或卷与话包含相同图片时不再请求',
+            texts=['不缓存', '512MB', '1GB', '2GB', '5GB', '10GB'],
+            parent=self.comicSettingGroup
+        )
+
+        self.isCropMarginsCard = SwitchSettingCard(
+            FIF.CUT,
+            '是否裁剪页面白边',
+            '如果开启，打包前会自动裁剪图片四周的白边',
+            configItem=cfg.isCropMargins,
+            parent=self.comicSettingGroup
+        )
+
+        self.isSplitSpreadsCard = SwitchSettingCard(
+            FIF.LAYOUT,
+            '是否拆分跨页',
+            '如果开启，横向的跨页图片会拆分成两页',
+            configItem=cfg.isSplitSpreads,
+            parent=self.comicSettingGroup
+        )
+
+        self.splitRightFirstCard = SwitchSettingCard(
+            FIF.RIGHT_ARROW,
+            '拆分跨页时右半页在前',
+            '适用于从右往左阅读的漫画，关闭后左半页在前',
+            configItem=cfg.splitRightFirst,
+            parent=self.comicSettingGroup
+        )
+
+        self.isTranscodeImagesCard = SwitchSettingCard(
+            FIF.PHOTO,
+            '是否按设备转码图片',
+            '如果开启，会按转换Mobi页面设置的设备分辨率缩放图片，黑白屏设备转换为灰度',
+            configItem=cfg.isTranscodeImages,
+            parent=self.comicSettingGroup
+        )
+
+        self.transcodeQualityCard = RangeSettingCard(
+            cfg.transcodeQuality,
+            FIF.ZOOM,
+            '转码图片质量',
+            '数值越小文件越小，画质越差',
+            self.comicSettingGroup
+        )
+
         # 个性化
         self.personalGroup = SettingCardGroup(
             '个性化', self.scrollWidget)
@@ -259,6 +359,10 @@ class SettingInterface(ScrollArea):
         # self.useSettingGroup.addSettingCard(self.useLocalServerCard)
         # 下载最大线程
         self.useSettingGroup.addSettingCard(self.downloadThreadNumCard)
+        # 图书下载限速
+        self.useSettingGroup.addSettingCard(self.bookSpeedLimitCard)
+        # 漫画下载限速
+        self.useSettingGroup.addSettingCard(self.comicSpeedLimitCard)
         # 下载目录
         self.useSettingGroup.addSettingCard(self.downloadFolderCard)
 
@@ -266,6 +370,12 @@ class SettingInterface(ScrollArea):
         self.comicSettingGroup.addSettingCard(self.epubSaveFolderCard)
         # 是否删除章节图片
         self.comicSettingGroup.addSettingCard(self.isDelChapterImagesCard)
+        # 是否生成epub
+        self.comicSettingGroup.addSettingCard(self.isSaveEpubCard)
+        # 是否生成cbz
+        self.comicSettingGroup.addSettingCard(self.isSaveCbzCard)
+        # 边下载边写入epub/cbz
+        self.comicSettingGroup.addSettingCard(self.isStreamEpubCard)
         # 是否合并保存PDF
         self.comicSettingGroup.addSettingCard(self.isSavePdfCard)
         # 是否转换成Mobi
@@ -274,6 +384,20 @@ class SettingInterface(ScrollArea):
         self.comicSettingGroup.addSettingCard(self.calibrePathCard)
         # 转换Mobi页面设置
         self.comicSettingGroup.addSettingCard(self.calibreOutputDeviceCard)
+        # 转换格式
+        self.comicSettingGroup.addSettingCard(self.calibreOutputFormatCard)
+        # 图片缓存容量
+        self.comicSettingGroup.addSettingCard(self.imageCacheSizeCard)
+        # 是否裁剪页面白边
+        self.comicSettingGroup.addSettingCard(self.isCropMarginsCard)
+        # 是否拆分跨页
+        self.comicSettingGroup.addSettingCard(self.isSplitSpreadsCard)
+        # 拆分跨页时右半页在前
+        self.comicSettingGroup.addSettingCard(self.splitRightFirstCard)
+        # 是否按设备转码图片
+        self.comicSettingGroup.addSettingCard(self.isTranscodeImagesCard)
+        # 转码图片质量
+        self.comicSettingGroup.addSettingCard(self.transcodeQualityCard)
 
         self.personalGroup.addSettingCard(self.themeCard)
         self.personalGroup.addSettingCard(self.themeColorCard)